@@ -18,9 +18,12 @@ else
 fi
 '''
 import appdirs, toml
-import logging, tempfile
+import logging
 import os,      sys
 import select
+import signal
+import stat
+import time
 
 if os.name != 'nt':
     import pty, termios, tty
@@ -30,25 +33,23 @@ import re
 import shutil
 import traceback
 import colorsys
-import base64
-import subprocess
-import pygments.util
 import textwrap
 import argparse
-from io import BytesIO
-from term_image.image import from_file, from_url
-from wcwidth import wcwidth
-from functools import reduce
+from io import BytesIO, StringIO
+from functools import lru_cache
 from argparse import ArgumentParser
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import TerminalTrueColorFormatter
-from pygments.styles import get_style_by_name
+
+# The heavy things (pygments, term_image, asyncio ...) get imported where they're
+# used so plain prose, which is most of what we see, doesn't pay for them.
 
 if __package__ is None:
     from plugins import *
+    from width import AnsiRe, display_width, truncate
+    from sgr import Sgr
 else:
     from .plugins import *
+    from .width import AnsiRe, display_width, truncate
+    from .sgr import Sgr
 
 default_toml = """
 [features]
@@ -56,9 +57,11 @@ CodeSpaces = false
 Clipboard  = true
 Logging    = false
 Timeout    = 0.1
+Latency    = 0.05
 Savebrace  = true
 Images     = true
 Links      = true
+Live       = false
 
 [style]
 Margin          = 2 
@@ -76,6 +79,11 @@ Bright  = { H = 1.00, S = 0.60, V = 2.00 }
 Syntax  = "native"
 """
 
+@lru_cache(maxsize=1)
+def default_config():
+    # This never changes so there's no need to parse it for every setup()
+    return toml.loads(default_toml)
+
 def ensure_config_file(config):
     config_dir = appdirs.user_config_dir("streamdown")
     os.makedirs(config_dir, exist_ok=True)
@@ -109,20 +117,53 @@ STRIKEOUT = ["\033[9m", "\033[29m"]
 LINK      = ["\033]8;;", "\033]8;;\033\\"]
 SUPER     = [ 0x2070, 0x00B9, 0x00B2, 0x00B3, 0x2074, 0x2075, 0x2076, 0x2077, 0x2078, 0x2079 ]
 
-ESCAPE = r"\033\[[0-9;]*[mK]"
-ANSIESCAPE = r'\033(?:\[[0-9;?]*[a-zA-Z]|][0-9]*;;.*?\\|\\)'
 KEYCODE_RE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-
-visible = lambda x: re.sub(ANSIESCAPE, "", x)
+# The highlighter's foreground and background resets
+CodeResetRe = re.compile(r"\033\[[34]9(;00|)m")
+
+# How much we ask for per read, we take whatever is actually available
+ChunkSize = 65536
+# How many lines a single multi-line token can span before we stop relexing it. This
+# is all of a code block we ever look at again, the lexer state carries the rest
+CodeCarry = 64
+# How much of a code block we hold on to in memory (for savebrace, the clipboard and
+# --scrape) before the rest of it goes out to a file
+CodeSpool = 1 << 20
+# How many languages and syntax themes we hold on to between code blocks
+LexerCache = 64
+FormatterCache = 16
+# How much rendered output we let pile up before writing it out regardless
+OutputBatch = 65536
+# How often we look at the terminal size when we can't get told about changes (seconds)
+ResizePoll = 0.5
+# Images are drawn this many rows tall
+ImageHeight = 20
+# How many images get decoded at once
+ImageWorkers = 4
+# How much of the rendered images we keep on disk before the least recently used go (bytes)
+ImageCache = 32 * 1024 * 1024
+# How much rendered output from --cache we keep on disk, the same way (bytes)
+RenderCache = 64 * 1024 * 1024
+# How long we hang around at the end of the stream for images that aren't done (seconds)
+ImageWait = 10
+# With the Live feature an incomplete line longer than this waits for its newline
+LiveMax = 4096
+
+visible = lambda x: AnsiRe.sub("", x)
 # many characters have different widths
-visible_length = lambda x: sum(wcwidth(c) for c in visible(x))
-extract_ansi_codes = lambda text: re.findall(ESCAPE, text)
-strip_ansi = lambda line: re.sub(ANSIESCAPE, '', line)
-scir = lambda line: strip_ansi(line) if state.block_depth > 0 else line
-remove_ansi = lambda line, codeList: reduce(lambda line, code: line.replace(code, ''), codeList, line)
-split_up = lambda line: re.findall(r'(\x1b[^m]*m|[^\x1b]*)', line)
+visible_length = display_width
+strip_ansi = lambda line: AnsiRe.sub('', line)
+
+def strip_codes(value):
+    # The same thing, or the same tuple or list of things, with the escape codes taken out
+    if isinstance(value, str):
+        return strip_ansi(value)
+    if isinstance(value, (tuple, list)):
+        return type(value)(strip_codes(item) for item in value)
+    return value
 
 def gettmpdir():
+    import tempfile
     tmp_dir_all = os.path.join(tempfile.gettempdir(), "sd")
     prev_mask = os.umask(0)
     os.makedirs(tmp_dir_all, mode=0o777, exist_ok=True)
@@ -138,123 +179,23 @@ def gettmpdir():
     os.umask(prev_mask)
     return tmp_dir
 
-def debug_write(text):
-    if state.Logging:
-        if state.Logging == True:
-            state.Logging = tempfile.NamedTemporaryFile(dir=gettmpdir(), prefix="dbg", delete=False, mode="wb")
-        state.Logging.write(text)
-
-def sub_extract(line, upto):
-    # this takes the line up to the upto string and then returns the ansi codes
-    return ''.join(extract_ansi_codes(line[:line.find(upto)]))
-
-def savebrace():
-    if state.Savebrace and state.code_buffer_raw and os.name != 'nt':
-        path = os.path.join(gettmpdir(), 'savebrace')
-        with open(path, "a") as f:
-            f.write(state.code_buffer_raw + "\x00")
-            f.flush()
-
 class Goto(Exception):
     pass
 
-class Streamdown:
-    def __init__(self):
-        self.Style = StyleClass()
-        self.state = ParseState()
-        self._setup = False
-        pass
-    
-    def setup(self, config_path = None, 
-              H = None, S = None, V = None, 
-              plaintext = False, scrape = None, width = None, prompt = None):
-        """Configure and initialize the Streamdown instance.
-
-        Load configuration, set style based on HSV values, and initialise feature
-
-        Loads the TOML configuration, merges any HSV overrides, builds the colour
-        palette and stores feature flags in ``self.state``. The method does not
-        return a value.
-
-        Parameters
-        ----------
-        config_path : str, optional
-            Path to a TOML configuration file.
-        H, S, V : float, optional
-            Override HSV values.
-        plaintext : bool, optional
-            Strip colour codes from output.
-        width : int, optional
-            Width to generated
-        prompt : str, optional
-            When detecting prompts in the exec mode this hints at what a valid prompt looks like
-
-        Raises
-        ------
-        FileNotFoundError, tomli.TomlDecodeError 
-        """
-
-        config = ensure_config_file(config_path)
-        style = toml.loads(default_toml).get('style') | config.get("style", {})
-        features = toml.loads(default_toml).get('features') | config.get("features", {})
-
-        if scrape:
-            os.makedirs(scrape, exist_ok=True)
-            self.state.scrape = scrape
-            
-        _H, _S, _V = style.get("HSV")
-        H = H or _H
-        S = S or _S
-        V = V or _V
-
-        for color in ["Dark", "Mid", "Symbol", "Head", "Grey", "Bright"]:
-            setattr(self.Style, color, apply_multipliers(style, color, H, S, V))
-        for attr in ['PrettyPad', 'PrettyBroken', 'Margin', 'ListIndent', 'Syntax', 'Plaintext']:
-            setattr(self.Style, attr, style.get(attr))
-
-        self.Style.Codebg = f"{BG}{self.Style.Dark}"
-        self.Style.Link = f"{FG}{self.Style.Symbol}{UNDERLINE[0]}"
-        self.Style.Plaintext = plaintext
-        self.Style.Blockquote = f"{FG}{self.Style.Grey}│ "
-        self.Style.MarginSpaces = " " * self.Style.Margin
-
-        for attr in ['Links', 'Images', 'CodeSpaces', 'Clipboard', 'Logging', 'Timeout', 'Savebrace']:
-            setattr(self.state, attr, features.get(attr))
-
-        self.state.WidthArg = int(width) or style.get("Width") or 0
-        self.state.prompt_regex = re.compile(prompt)
-        width_calc()
-        self._setup = True
-
-    def tidyup(self):
-        """Returns the terminal to normal"""
-        if os.isatty(sys.stdout.fileno()) and self.state.Clipboard and self.state.code_buffer_raw:
-            code = self.state.code_buffer_raw
-            # code needs to be a base64 encoded string before emitting
-            code_bytes = code.encode('utf-8')
-            base64_bytes = base64.b64encode(code_bytes)
-            base64_string = base64_bytes.decode('utf-8')
-            print(f"\033]52;c;{base64_string}\a", end="", flush=True)
-
-        if self.state.terminal:
-            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.state.terminal)
-            os.close(self.state.exec_master)
-            if self.state.exec_sub:
-                self.state.exec_sub.wait()
-
-        print(terminal_prep(RESET), end="")
-
-    def render(self,inp):
-        """Renders the content"""
-
-        if not self._setup:
-            self.setup()
-
-        return emit(inp)
-
 class StyleClass:
+    # The palette and everything built out of it. The escape sequences that go around
+    # headers, table cells and so on are put together once in setup() and looked up after
     def __init__(self):
-        pass
+        self.PrefixMap = {}
+
+    def prefix(self, items, depth):
+        # What goes in front of a line, the margin plus any list indent and blockquote
+        # bars, and how wide that is. There's only ever a handful of these
+        key = (items, depth)
+        if key not in self.PrefixMap:
+            text = ' ' * items * self.ListIndent + self.MarginSpaces + self.Blockquote * depth
+            self.PrefixMap[key] = (text, len(visible(text)))
+        return self.PrefixMap[key]
 
 class Code:
     Spaces = 'spaces'
@@ -263,17 +204,91 @@ class Code:
     Body = 'body'
     Flush = 'flush'
 
+class Line:
+    # What classify() says a line is. indent is how much whitespace it starts with
+    # and match is what the pattern for its kind captured
+    Block = 'block'
+    Fence = 'fence'
+    Table = 'table'
+    Item = 'item'
+    Header = 'header'
+    Rule = 'rule'
+    Text = 'text'
+
+    __slots__ = ('kind', 'indent', 'match')
+    def __init__(self, kind, indent = 0, match = None):
+        self.kind = kind
+        self.indent = indent
+        self.match = match
+
+# So kimi doesn't newline after the <think> token and it uses some unicode triangle?. They'll
+# newline at the end of it, but not the beginning.
+BlockRe = re.compile(r"^\s*((>\s*)+|[◁<].?think[>▷])(.*)")
+FenceRe = re.compile(r"^\s*(```|<pre>)\s*([^\s]+|$)\s*$")
+TableRe = re.compile(r"^\s*\|.+\|\s*$")
+# llama-4 maverick uses + and +- for lists ... for some reason
+ItemRe = re.compile(r"^(\s*)([\+*\-] |\+\-+|\d+\.\s+)(.*)")
+HeaderRe = re.compile(r"^\s*(#{1,6})\s*(.*)")
+RuleRe = re.compile(r"^[\s]*([-\*=_]){3,}[\s]*$")
+# What line_format looks for: the emphasis and code markers and the [ of links, images and footnotes
+MarkupRe = re.compile(r"[~_*`\[]")
+SpaceRe = re.compile(r"\s+")
+
+# Every one of those has to start with one of a few characters so that's all we look
+# at to know which to try, in the order they get tried. Most lines are prose and
+# don't start with any of them
+LeadMap = {
+    '>': [(Line.Block, BlockRe)],
+    '◁': [(Line.Block, BlockRe)],
+    '<': [(Line.Block, BlockRe), (Line.Fence, FenceRe)],
+    '`': [(Line.Fence, FenceRe)],
+    '|': [(Line.Table, TableRe)],
+    '+': [(Line.Item, ItemRe)],
+    '-': [(Line.Item, ItemRe), (Line.Rule, RuleRe)],
+    '*': [(Line.Item, ItemRe), (Line.Rule, RuleRe)],
+    '#': [(Line.Header, HeaderRe)],
+    '=': [(Line.Rule, RuleRe)],
+    '_': [(Line.Rule, RuleRe)],
+} | {digit: [(Line.Item, ItemRe)] for digit in '0123456789'}
+
+def classify(line, quotes = True):
+    # quotes is whether a blockquote or <think> counts, those are only looked for
+    # before the line has been through the rest of the layout
+    stripped = line.lstrip()
+    indent = len(line) - len(stripped)
+    for kind, regex in LeadMap.get(stripped[:1], []):
+        if kind == Line.Block and not quotes:
+            continue
+        match = regex.match(line)
+        if match:
+            return Line(kind, indent, match)
+    return Line(Line.Text, indent)
+
 class ParseState:
-    def __init__(self):
-        self.buffer = b''
+    def __init__(self, style):
+        # The widths depend on the margins and indents of the style we're rendering with
+        self.Style = style
+        self.buffer = bytearray()
         self.current_line = ''
         self.first_line = True
         self.last_line_empty = True
+        self.last_line_empty_cache = None
         self.is_pty = False
         self.is_exec = False
         self.maybe_prompt = False
         self.prompt_regex = None
         self.emit_flag = None
+        self.emit_buffer = []
+        # Images from the line being laid out and the ones waiting to be painted in
+        self.image_list = []
+        self.image_pending = []
+        # With the Live feature, the rows drawn for the incomplete line and what they were drawn from
+        self.live_rowList = []
+        self.live_key = None
+        # Whether what's gone out so far finished its line, the preview needs a line to itself
+        self.line_done = True
+        # What events() has noted down and not handed out yet, None when nobody's asking
+        self.event_list = None
         self.scrape = None
         self.scrape_ix = 0
         self.terminal = None
@@ -281,6 +296,11 @@ class ParseState:
         self.WidthArg = None
         self.WidthFull = None
         self.WidthWrap = False
+        # What the width strings were last built for and when we last measured
+        self.width_key = None
+        self.resize_seen = -1
+        self.resize_time = 0
+        self.resize_hooked = False
 
         # If the entire block is indented this will
         # tell us what that is
@@ -290,9 +310,13 @@ class ParseState:
 
         # These are part of a trick to get
         # streaming code blocks while preserving
-        # multiline parsing.
-        self.code_buffer = ""
-        self.code_buffer_raw = ""
+        # multiline parsing. The checkpoint is where
+        # the lexer left off at the end of the last line.
+        self.code_buffer_raw = Spool()
+        self.code_checkpoint = None
+        self.code_carry = ''
+        self.code_lexer = None
+        self.code_formatter = None
         self.code_gen = 0
         self.code_language = None
         self.code_first_line = False
@@ -331,167 +355,149 @@ class ParseState:
         self.inline_code = self.in_bold = self.in_italic = self.in_underline = self.in_strikeout = False
 
     def full_width(self, offset = 0):
-        return offset + (state.current_width(listwidth = True) if Style.PrettyBroken else self.WidthFull)
+        return offset + (self.current_width(listwidth = True) if self.Style.PrettyBroken else self.WidthFull)
 
     def current_width(self, listwidth = False):
         # this will double count the left margin
-        return self.Width - (len(visible(self.space_left(listwidth)))) + Style.Margin
+        width = 0 if len(self.current_line) else self.Style.prefix(len(self.list_item_stack) if listwidth else 0, self.block_depth)[1]
+        return self.Width - width + self.Style.Margin
 
     def space_left(self, listwidth = False):
-        pre = ' ' * (len(state.list_item_stack)) * Style.ListIndent if listwidth else ''
-        return pre + Style.MarginSpaces + (Style.Blockquote * self.block_depth) if len(self.current_line) == 0 else "" 
+        return "" if len(self.current_line) else self.Style.prefix(len(self.list_item_stack) if listwidth else 0, self.block_depth)[0]
 
 def override_background(style_name, background_color):
+    # We derive a new style rather than changing the one pygments hands
+    # out to everybody, other renderers may be using another background
+    from pygments.styles import get_style_by_name
     base_style = get_style_by_name(style_name)
-    base_style.background_color = background_color
-    for i in base_style:
-        i[1]['bgcolor'] = background_color
+    styles = {}
     for i,v in base_style.styles.items():
-        if v and 'bg' in v:
-            base_style.styles[i] = re.sub(r'bg:[^ ]*', '', base_style.styles[i] )
-    for k,v in base_style._styles.items():
+        styles[i] = re.sub(r'bg:[^ ]*', '', v) if v and 'bg' in v else v
+
+    custom_style = type(base_style.__name__, (base_style,), {'background_color': background_color, 'styles': styles})
+    for k,v in custom_style._styles.items():
          if v[4] != '':
              v[4] = ''
 
-    return base_style
-
-def format_table(rowList):
-    num_cols = len(rowList)
-    row_height = 0
-    wrapped_cellList = []
-
-    # Calculate max width per column (integer division)
-    # Subtract num_cols + 1 for the vertical borders '│'
-    available_width = state.current_width() - (num_cols * 2)
-
-    width_base = available_width // num_cols
-    width_mod  = available_width % num_cols
-
-    col_width_list = [width_base + (1 if i < width_mod else 0) for i in range(num_cols)]
-    bg_color = Style.Mid if state.in_table == Style.Head else Style.Dark
-    state.bg = f"{BG}{bg_color}"
-
-    # First Pass: Wrap text and calculate row heights
-    # Note this is where every cell is formatted so if 
-    # you are styling, do it before here!
-    for ix in range(len(rowList)):
-        row = rowList[ix]
-        wrapped_cell = text_wrap(row, width=col_width_list[ix], force_truncate=True, preserve_format=True)
-
-        # Ensure at least one line, even for empty cells
-        if not wrapped_cell:
-            wrapped_cell = [""]
-
-        wrapped_cellList.append(wrapped_cell)
-        row_height = max(row_height, len(wrapped_cell))
-
-    # --- Second Pass: Format and emit rows ---
-    for ix in range(row_height):
-        # This is the fancy row separator
-        extra = f"\033[4;58;2;{Style.Mid}" if not state.in_table == Style.Head and (ix == row_height - 1) else ""
-        line_segments = []
-
-        # Now we want to snatch this row index from all our cells
-        for iy in range(len(wrapped_cellList)):
-            cell = wrapped_cellList[iy]
-            segment = ''
-            if ix < len(cell):
-                segment = cell[ix]
-
-            # Margin logic is correctly indented here
-            margin_needed = col_width_list[iy] - visible_length(segment)
-            margin_segment = segment + (" " * max(0, margin_needed))
-            line_segments.append(f"{BG}{bg_color}{extra} {margin_segment}")
-
-        # Correct indentation: This should be outside the c_idx loop
-        joined_line = f"{BG}{bg_color}{extra}{FG}{Style.Symbol}│{RESET}".join(line_segments)
-        # Correct indentation and add missing characters
-        yield f"{state.space_left()}{FGRESET}{joined_line}{RESET}"
-
-    state.bg = BGRESET
-
-def emit_h(level, text):
-    text = line_format(text)
-    lineList = text_wrap(text)
-    res = []
-    for text in lineList:
-        spaces_to_center = (state.current_width() -  visible_length(text)) / 2
-        if level == 1:      #
-            res.append(f"{state.space_left()}\n{state.space_left()}{BOLD[0]}{' ' * math.floor(spaces_to_center)}{text}{BOLD[1]}\n")
-        elif level == 2:    ##
-            res.append(f"{state.space_left()}\n{state.space_left()}{BOLD[0]}{FG}{Style.Bright}{' ' * math.floor(spaces_to_center)}{text}{' ' * math.ceil(spaces_to_center)}{BOLD[1]}{FGRESET}")
-        elif level == 3:    ###
-            res.append(f"{state.space_left()}{FG}{Style.Head}{BOLD[0]}{text}{BOLD[1]}{FGRESET}")
-        elif level == 4:    ####
-            res.append(f"{state.space_left()}{FG}{Style.Symbol}{BOLD[0]}{text}{BOLD[1]}{FGRESET}")
-        elif level == 5:    #####
-            res.append(f"{state.space_left()}{text}{FGRESET}")
-        else: 
-            res.append(f"{state.space_left()}{FG}{Style.Grey}{text}{FGRESET}")
-    return "\n".join(res)
-
-def code_wrap(text_in):
-    if not Style.PrettyBroken and state.WidthWrap and len(text_in) > state.full_width():
-        return (0, [text_in])
-
-    # get the indentation of the first line
-    indent = len(text_in) - len(text_in.lstrip())
-    text = text_in.lstrip()
-    mywidth = state.full_width(-4 if Style.PrettyBroken else 0) - indent
-
-    # We take special care to preserve empty lines
-    if len(text) == 0:
-        return (0, [text_in])
-    res = [text[:mywidth]]
-
-    for i in range(mywidth, len(text), mywidth):
-        res.append(text[i : i + mywidth])
-
-    # sometimes just a newline wraps ... this isn't what we want actually
-    if res[-1].strip() == '':
-        res.pop()
-
-    return (indent, res)
-
-
-# This marvelously obscure code "compacts" long lines of repetitive ANSI format strings by
-# removing duplicates. Here's how it works
-def ansi_collapse(codelist, inp):
-    # We break SGR strings into various classes concerning their applicate or removal
-    nums = {
-        'fg': r'3\d', 'bg': r'4\d',
-        'b': r'2?[12]', 'i': r'2?3', 'u': r'3?2',
-        'reset': '0'
-    }
-
-    # We have a routine that creates large regex matching strings for them based on 
-    # lists that can pass to it
-    sgr = lambda l: re.compile(r'\x1b\[(' + '|'.join(l) +')[0-9;]*m')
-
-    for stanza in inp:
-        # We construct a named-register regex using the dictionary and run it
-        # over a stanza of our input
-        mg = re.search( sgr([f'(?P<{k}>{v})' for k, v in nums.items()]), stanza )
-
-        if mg:
-            # this means we now have a dictionary populated with whether 
-            # we have those tags or not
-            mg = mg.groupdict()
+    return custom_style
 
-            # if it's a reset we can disregard everything
-            if mg['reset']:
-                return inp                 
-
-            # Find the tags we have by doing a dictionary None check. Make new regex SGR ANSI codes from it
-            my_filter = sgr( [nums[k] for k, v in mg.items() if v] )
-
-            # Use that code list as a filter to remove extra
-            codelist = list(filter(lambda x: not re.search( my_filter, x ), codelist))
+@lru_cache(maxsize=LexerCache)
+def get_lexer(language):
+    # Fence tags we don't know (jsonc, ...) fall back to Bash. We remember
+    # that as well so we don't pay for the exception on every block
+    import pygments.util
+    from pygments.lexers import get_lexer_by_name
+    try:
+        return get_lexer_by_name(language), True
+    except pygments.util.ClassNotFound as e:
+        logging.debug(e)
+        return get_lexer_by_name("Bash"), False
+
+@lru_cache(maxsize=FormatterCache)
+def get_formatter(style_name, background_color):
+    from pygments.formatters import TerminalTrueColorFormatter
+    return TerminalTrueColorFormatter(style=override_background(style_name, background_color))
+
+@lru_cache(maxsize=1)
+def token_type():
+    # regex_lex goes through the insides of RegexLexer, if they've moved we go without it
+    try:
+        from pygments.token import _TokenType
+        return _TokenType
+    except ImportError:
+        return None
+
+def regex_lex(lexer, text, stack):
+    # This is RegexLexer.get_tokens_unprocessed except that it also hands back the
+    # state stack it finished in and where it would have to start again from (and in
+    # what state) to lex anything added to the end of text the way it would be if it
+    # had all been there at once. That's the start of the line the last token started
+    # on: a match that ran into the end of the text might have gone differently with
+    # more of it (a setext underline, <script> running into the next line ...)
+    from pygments.token import Error, Whitespace
+    TokenType = token_type()
+    pos = 0
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+    # The last place at or before the start of the line we're on that we know the state at
+    linemark = resume = (0, list(statestack))
+    tokenList = []
+    while True:
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is TokenType:
+                        tokenList.append((pos, action, m.group()))
+                    else:
+                        tokenList.extend(action(lexer, m))
+                if m.end() > pos:
+                    resume = linemark
+                    newline = text.rfind('\n', pos, m.end())
+                    if newline >= 0 and newline < m.end() - 1:
+                        # the line starts in the middle of this one
+                        linemark = (pos, list(statestack))
+                    elif newline >= 0:
+                        linemark = None
+                pos = m.end()
+                if new_state is not None:
+                    if isinstance(new_state, tuple):
+                        for name in new_state:
+                            if name == '#pop':
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif name == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(name)
+                    elif isinstance(new_state, int):
+                        if abs(new_state) >= len(statestack):
+                            del statestack[1:]
+                        else:
+                            del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    statetokens = tokendefs[statestack[-1]]
+                if linemark is None:
+                    # it ended on a newline, the next line starts here
+                    linemark = (pos, list(statestack))
+                break
+        else:
+            if pos >= len(text):
+                break
+            resume = linemark
+            if text[pos] == '\n':
+                statestack = ['root']
+                statetokens = tokendefs['root']
+                tokenList.append((pos, Whitespace, '\n'))
+                linemark = (pos + 1, ['root'])
+            else:
+                tokenList.append((pos, Error, text[pos]))
+            pos += 1
 
-    return codelist + inp
+    return tokenList, statestack, resume
 
+def clip_tokens(tokenList, start, end = None):
+    # The tokens, trimmed down to the text between start and end
+    res = []
+    pos = 0
+    for ttype, value in tokenList:
+        if pos + len(value) > start and (end is None or pos < end):
+            res.append((ttype, value[max(0, start - pos) : None if end is None else end - pos]))
+        pos += len(value)
+    return res
+
+def highlight_tokens(tokenList, start, end, formatter):
+    # Renders the part of a lexed line that falls between start and end
+    out = StringIO()
+    formatter.format(clip_tokens(tokenList, start, end), out)
+    return out.getvalue()
 
 def split_text(text):
+    # None of the CJK characters it also splits around are ascii
+    if text.isascii():
+        return text.split()
     return [x for x in re.split(
         r'(?<=['
             r'\u3000-\u303F'
@@ -506,242 +512,974 @@ def split_text(text):
         text
     ) if x]
 
-def text_wrap(text, width = -1, indent = 0, first_line_prefix="", subsequent_line_prefix="", force_truncate=False, preserve_format=False):
-    if width == -1:
-        width = state.Width
+CjkRe = re.compile(
+    r'[\u4E00-\u9FFF'      # CJK Unified Ideographs
+    r'\u3400-\u4DBF'       # CJK Unified Ideographs Extension A
+    r'\uF900-\uFAFF'       # CJK Compatibility Ideographs
+    r'\uFF00-\uFFEF'       # CJK Compatibility Punctuation
+    r'\u3000-\u303F'      # CJK Symbols and Punctuation
+    r'\U0002F800-\U0002FA1F]' # CJK Compatibility Ideographs Supplement
+)
+
+def cjk_count(s):
+    # None of them are ascii
+    if s.isascii():
+        return 0
+    return len(CjkRe.findall(visible(s) if '\033' in s else s))
+
+def read_chunk(stream):
+    # read1 hands back whatever is already buffered rather than blocking
+    # until the full chunk arrives, which matters for fifos and <(...)
+    reader = getattr(stream, 'read1', stream.read)
+    data = reader(ChunkSize)
+    return data.encode('utf-8') if isinstance(data, str) else data
+
+class BatchWriter:
+    # The parser hands back lots of little chunks. Rather than a write and flush for
+    # every one of them we gather them up and write them out together: when enough
+    # has piled up, when the oldest has been waiting longer than the latency cap
+    # (terminals only, a pipe or a file doesn't care) or when we're told to.
+    def __init__(self, file, latency):
+        self.file = file
+        self.latency = latency or 0
+        self.interactive = file.isatty()
+        self.pending = []
+        self.size = 0
+        self.since = 0
+        # How many lines have gone out, this is how we find our way back up to an image
+        self.rows = 0
+
+    def write(self, chunk):
+        if not chunk:
+            return
+
+        self.rows += chunk.count('\n')
+        if not self.pending:
+            self.since = time.monotonic()
+
+        self.pending.append(chunk)
+        self.size += len(chunk)
+
+        if self.interactive and time.monotonic() - self.since >= self.latency:
+            self.flush()
+
+        elif self.size >= OutputBatch:
+            # Not a terminal so this can sit in the file's own buffer
+            self.file.write(''.join(self.pending))
+            self.pending = []
+            self.size = 0
+
+    def flush(self):
+        if self.pending:
+            self.file.write(''.join(self.pending))
+            self.pending = []
+            self.size = 0
+        self.file.flush()
+
+class Spool:
+    # The raw text of the code block we're in. Models will happily dump a 50k line log
+    # into a fence so past CodeSpool this goes to a file in the tmpdir instead
+    def __init__(self):
+        self.pieceList = []
+        self.size = 0
+        self.file = None
+
+    def __bool__(self):
+        return self.size > 0
+
+    def write(self, text):
+        self.size += len(text)
+        if self.file:
+            self.file.write(text)
+            return
+
+        self.pieceList.append(text)
+        if self.size > CodeSpool:
+            import tempfile
+            self.file = tempfile.TemporaryFile('w+', encoding='utf-8', dir=gettmpdir())
+            self.file.write(''.join(self.pieceList))
+            self.pieceList = []
+
+    def clear(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.pieceList = []
+        self.size = 0
+
+    def copy_to(self, f):
+        if self.file:
+            self.file.seek(0)
+            shutil.copyfileobj(self.file, f)
+        else:
+            f.write(''.join(self.pieceList))
+
+    def getvalue(self):
+        out = StringIO()
+        self.copy_to(out)
+        return out.getvalue()
+
+class Resize:
+    # SIGWINCH goes to the whole process so this is shared by every instance.
+    # Each one remembers the count it last measured at and looks again when it moves
+    count = 0
+    hooked = False
 
-    # The empty word clears the buffer at the end.
-    formatted = line_format(text)
-    words = split_text(formatted) + [""]
+    @staticmethod
+    def listen():
+        if Resize.hooked:
+            return True
 
-    lines = []
-    current_line = ""
-    current_style = []
-    resetter = "" if preserve_format else FORMATRESET 
+        if not hasattr(signal, 'SIGWINCH'):
+            return False
+
+        previous = signal.getsignal(signal.SIGWINCH)
+        def handler(signum, frame):
+            Resize.count += 1
+            if callable(previous):
+                previous(signum, frame)
+
+        try:
+            signal.signal(signal.SIGWINCH, handler)
+        except ValueError:
+            # Only the main thread gets to do this
+            return False
+
+        Resize.hooked = True
+        return True
+
+class Image:
+    # An image on its way out. It's either rendered already (text) or being rendered
+    # (future). mark is the first line of its placeholder and row is where that went
+    def __init__(self, url, future = None, text = None):
+        self.url = url
+        self.future = future
+        self.text = text
+        self.mark = None
+        self.row = None
+
+is_url = lambda url: re.match(r"https?://", url.lower())
+
+@lru_cache(maxsize=1)
+def image_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=ImageWorkers, thread_name_prefix='sd-image')
+
+def image_path(url, height):
+    # Where the rendered image lives in the cache. A file can change under the same name
+    # so its mtime is part of it and how it gets drawn (blocks, kitty ...) depends on the terminal
+    import hashlib
+    cache_dir = cache_path('images')
+    if not cache_dir:
+        return None
+    if not is_url(url):
+        url = f"{os.path.abspath(url)}:{os.stat(url).st_mtime_ns}"
+    key = '\0'.join([url, str(height), os.environ.get('TERM', ''), os.environ.get('TERM_PROGRAM', '')])
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+def image_render(url, height, path):
+    # This can run on the image pool so it stays away from anything on the instance
+    data = cache_read(path)
+    if data is not None:
+        return data.decode('utf-8', 'replace')
+
+    from term_image.image import from_file, from_url
+    image = from_url(url) if is_url(url) else from_file(url)
+    image.height = height
+    text = f"{image:|.-1#}"
+    cache_save(path, text.encode('utf-8'), ImageCache)
+    return text
+
+def cache_path(name):
+    # One of the caches under gettmpdir(). What's in them goes straight to the terminal and
+    # everyone can write to where they are, so the directory has to be ours and only ours.
+    # None if it isn't, then we go without
+    path = os.path.join(gettmpdir(), name)
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.lstat(path)
+        if os.name != 'nt':
+            if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+                logging.debug(f"{path} isn't ours, not caching there")
+                return None
+            if info.st_mode & 0o077:
+                os.chmod(path, 0o700)
+    except OSError:
+        return None
+    return path
+
+def cache_read(path):
+    # What's in a cache entry as bytes, or None if it isn't there or isn't one we wrote
+    if not path:
+        return None
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        with os.fdopen(fd, 'rb') as f:
+            if os.name != 'nt' and os.fstat(fd).st_uid != os.getuid():
+                return None
+            data = f.read()
+        # it's now the most recently used
+        os.utime(path)
+        return data
+    except OSError:
+        return None
+
+def cache_save(path, data, limit):
+    # Puts an entry (bytes, as they are, no newline translation) in one of the caches under
+    # gettmpdir() and, if that takes it over limit bytes, clears out the least recently used
+    import tempfile
+    if not path:
+        return
+    cache_dir = os.path.dirname(path)
+    try:
+        # Written off to the side and moved in so nobody ever reads half of one
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            # likely out of space, what's there is still good
+            os.unlink(tmp)
+            raise
+
+        entryList = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                for entry in os.scandir(cache_dir) if not entry.name.startswith('.'))
+    except OSError:
+        return
+
+    total = sum(size for _, size, _ in entryList)
+    for _, size, name in entryList:
+        if total <= limit:
+            break
+        try:
+            os.unlink(name)
+        except OSError:
+            # someone else got to it
+            pass
+        total -= size
+
+def ansi2hex(ansi_code):
+    parts = ansi_code.strip('m').split(";")
+    r, g, b = map(int, parts)
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+def apply_multipliers(style, name, H, S, V):
+    m = style.get(name)
+    r, g, b = colorsys.hsv_to_rgb(min(1.0, H * m["H"]), min(1.0, S * m["S"]), min(1.0, V * m["V"]))
+    return ';'.join([str(int(x * 255)) for x in [r, g, b]]) + "m"
+
+class Streamdown:
+    def __init__(self, output = None):
+        # Everything about a render lives on the instance so any
+        # number of them can run side by side
+        self.Style = StyleClass()
+        self.state = ParseState(self.Style)
+        self.output = output
+        self.writer = None
+        self._setup = False
     
-    oldword = ''
-    for word in words:
-        # we apply the style if we see it at the beginning of the word
-        codes = extract_ansi_codes(word)
-        if len(codes) and word.startswith(codes[0]):
-            # this pop(0) is intentional
-            current_style.append(codes.pop(0))
-
-        if len(word) and visible_length(current_line) + visible_length(word) + 1 <= width:  # +1 for space
-            space = ""
-            if len(visible(word)) > 0 and current_line:
-                space = " "
-            if (":" in visible(word) or cjk_count(word)) and cjk_count(oldword):
-                space = ""
-            current_line += space + word
-        else:
-            # Word doesn't fit, finalize the previous line
-            prefix = first_line_prefix if not lines else subsequent_line_prefix
-            line_content = prefix + current_line  
-            # This is expensive, fix.
-            while force_truncate and visible_length(line_content) >= width:
-                line_content = line_content[:len(line_content) - 2] + "…"
+    def setup(self, config_path = None, 
+              H = None, S = None, V = None, 
+              plaintext = False, scrape = None, width = None, prompt = r"^.*>\s+$"):
+        """Configure and initialize the Streamdown instance.
 
-            margin = max(0, width - visible_length(line_content))
+        Load configuration, set style based on HSV values, and initialise feature
 
-            if line_content.strip() != "":
-                # We make absolutely positively sure beyond any doubt
-                # that we have closed our hyperlink OSC
-                if LINK[0] in line_content:
-                    line_content += LINK[1]
-                lines.append(line_content + resetter + sub_extract(line_content, LINK[0]) + state.bg + ' ' * margin)
+        Loads the TOML configuration, merges any HSV overrides, builds the colour
+        palette and stores feature flags in ``self.state``. The method does not
+        return a value.
 
-            current_line = (" " * indent) + "".join(current_style) + word
+        Parameters
+        ----------
+        config_path : str, optional
+            Path to a TOML configuration file.
+        H, S, V : float, optional
+            Override HSV values.
+        plaintext : bool, optional
+            Strip colour codes from output.
+        width : int, optional
+            Width to generated
+        prompt : str, optional
+            When detecting prompts in the exec mode this hints at what a valid prompt looks like
 
-        if len(codes):
-            current_style += codes
+        Raises
+        ------
+        FileNotFoundError, tomli.TomlDecodeError 
+        """
 
-        if codes:
-            current_style = ansi_collapse(current_style, codes)
+        config = ensure_config_file(config_path)
+        style = default_config().get('style') | config.get("style", {})
+        features = default_config().get('features') | config.get("features", {})
 
-        oldword = word
+        if scrape:
+            os.makedirs(scrape, exist_ok=True)
+            self.state.scrape = scrape
+            
+        _H, _S, _V = style.get("HSV")
+        H = H or _H
+        S = S or _S
+        V = V or _V
 
-    if len(lines) < 1:
-        return []
+        for color in ["Dark", "Mid", "Symbol", "Head", "Grey", "Bright"]:
+            setattr(self.Style, color, apply_multipliers(style, color, H, S, V))
+        for attr in ['PrettyPad', 'PrettyBroken', 'Margin', 'ListIndent', 'Syntax', 'Plaintext']:
+            setattr(self.Style, attr, style.get(attr))
 
-    if len(lines) == 1:
-        lines[0] = lines[0].rstrip()
+        self.Style.Codebg = f"{BG}{self.Style.Dark}"
+        self.Style.Link = f"{FG}{self.Style.Symbol}{UNDERLINE[0]}"
+        self.Style.Plaintext = plaintext
+        self.Style.Blockquote = f"{FG}{self.Style.Grey}│ "
+        self.Style.MarginSpaces = " " * self.Style.Margin
+        self.Style.PrefixMap = {}
+
+        # Inline code, list bullets and what goes either side of a header, by level
+        self.Style.Inline = f"{BG}{self.Style.Mid}"
+        self.Style.Bullet = f"{FG}{self.Style.Symbol}"
+        self.Style.HeadList = [
+            None,
+            (BOLD[0], f"{BOLD[1]}\n"),
+            (f"{BOLD[0]}{FG}{self.Style.Bright}", f"{BOLD[1]}{FGRESET}"),
+            (f"{FG}{self.Style.Head}{BOLD[0]}", f"{BOLD[1]}{FGRESET}"),
+            (f"{FG}{self.Style.Symbol}{BOLD[0]}", f"{BOLD[1]}{FGRESET}"),
+            ("", FGRESET),
+            (f"{FG}{self.Style.Grey}", FGRESET),
+        ]
+        # Table cells and the border between them for the header, the body and the
+        # underlined last line of a body row
+        border = f"{FG}{self.Style.Symbol}│{RESET}"
+        underline = f"\033[4;58;2;{self.Style.Mid}"
+        self.Style.TableHead = (f"{BG}{self.Style.Mid}", f"{BG}{self.Style.Mid}{border}")
+        self.Style.TableBody = (self.Style.Codebg, f"{self.Style.Codebg}{border}")
+        self.Style.TableLast = (f"{self.Style.Codebg}{underline}", f"{self.Style.Codebg}{underline}{border}")
+
+        # What turns the formatting on and off
+        self.Style.Bold, self.Style.Italic, self.Style.Underline, self.Style.Strikeout = BOLD, ITALIC, UNDERLINE, STRIKEOUT
+        self.Style.Reset, self.Style.FgReset, self.Style.BgReset, self.Style.FormatReset = RESET, FGRESET, BGRESET, FORMATRESET
+
+        if plaintext:
+            # Nothing gets drawn so the codes come off once here instead of being put in
+            # every line and stripped back out of it on the way out
+            for attr, value in list(vars(self.Style).items()):
+                setattr(self.Style, attr, strip_codes(value))
+        self.state.bg = self.Style.BgReset
+
+        for attr in ['Links', 'Images', 'CodeSpaces', 'Clipboard', 'Logging', 'Timeout', 'Latency', 'Savebrace', 'Live']:
+            setattr(self.state, attr, features.get(attr))
 
-    return lines
+        self.state.WidthArg = int(width or 0) or style.get("Width") or 0
+        self.state.prompt_regex = re.compile(prompt)
+        out = self.output or sys.stdout
+        self.state.resize_hooked = not self.state.WidthArg and out.isatty() and Resize.listen()
+        self.state.width_key = None
+        self.width_calc()
+        self._setup = True
 
-def cjk_count(s):
-    cjk_re = re.compile(
-        r'[\u4E00-\u9FFF'      # CJK Unified Ideographs
-        r'\u3400-\u4DBF'       # CJK Unified Ideographs Extension A
-        r'\uF900-\uFAFF'       # CJK Compatibility Ideographs
-        r'\uFF00-\uFFEF'       # CJK Compatibility Punctuation
-        r'\u3000-\u303F'      # CJK Symbols and Punctuation
-        r'\U0002F800-\U0002FA1F]' # CJK Compatibility Ideographs Supplement
-    )
-    
-    return len(cjk_re.findall(visible(s)))
+    def tidyup(self):
+        """Returns the terminal to normal"""
+        out = self.output or sys.stdout
+        if out.isatty() and self.state.Clipboard and self.state.code_buffer_raw:
+            code = self.state.code_buffer_raw.getvalue()
+            # code needs to be a base64 encoded string before emitting
+            import base64
+            code_bytes = code.encode('utf-8')
+            base64_bytes = base64.b64encode(code_bytes)
+            base64_string = base64_bytes.decode('utf-8')
+            print(f"\033]52;c;{base64_string}\a", end="", file=out, flush=True)
+
+        if self.state.terminal:
+            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.state.terminal)
+            os.close(self.state.exec_master)
+            if self.state.exec_sub:
+                self.state.exec_sub.wait()
+
+        print(self.terminal_prep(RESET), end="", file=out)
+
+    def profile(self):
+        """Starts counting where the time goes. Call report() or table() on what
+        comes back for the numbers and stop() when you're done"""
+        if __package__ is None:
+            from timing import Profile
+        else:
+            from .timing import Profile
+        return Profile(self, globals())
+
+    def render(self,inp):
+        """Renders the content"""
+
+        if not self._setup:
+            self.setup()
+
+        return self.emit(inp)
+
+    def events(self, inp):
+        """Parse the content like render() does but yield what's in it as dicts.
+
+        Each one has a ``type``: header (level, text), item (depth, number, text),
+        text (text and depth in a list), table_row (header, cells), code_start
+        (language), code_line (text), code_end (language, text), quote_start (kind,
+        depth), quote_end (kind), rule and blank. The text has the inline markdown
+        taken out. They come out as soon as the line they're from is understood, a
+        line of text waits on the next one since that can make it a header.
+        """
+        if not self._setup:
+            self.setup()
+
+        state, Style = self.state, self.Style
+        # Nothing is drawn so there's no need to highlight anything either
+        plaintext, Style.Plaintext = Style.Plaintext, True
+        state.event_list = []
+        held = None
+
+        def drain():
+            nonlocal held
+            eventList, state.event_list = state.event_list, []
+            for event in eventList:
+                if event['type'] == 'setext':
+                    # This makes the line before it a header, if it was some text
+                    if held:
+                        yield {'type': 'header', 'level': event['level'], 'text': held['text']}
+                        held = None
+                    else:
+                        yield {'type': 'rule'}
+                    continue
 
-def line_format(line):
-    not_text = lambda token: not (token.isalnum() or token in ['\\','"']) or cjk_count(token)
-    footnotes = lambda match: ''.join([chr(SUPER[int(i)]) for i in match.group(1)])
+                if held:
+                    yield held
+                    held = None
+                if event['type'] == 'text' and 'depth' not in event:
+                    held = event
+                else:
+                    yield event
 
-    def process_images(match):
-        url = match.group(2)
         try:
-            if re.match(r"https://", url.lower()):
-                image = from_url(url)
-            else: 
-                image = from_file(url)
-            image.height = 20
-            print(f"{image:|.-1#}")
-        except:
-            return match.group(2)
-
-    # Apply OSC 8 hyperlink formatting after other formatting
-    def process_links(match):
-        #import pdb
-        #pdb.set_trace()
-        #print(match)
-        description = match.group(1)
-        url = match.group(2)
-        return f'{LINK[0]}{url}\033\\{Style.Link}{description}{UNDERLINE[1]}{LINK[1]}{FGRESET}'
-
-    if state.Images:
-        line = re.sub(r"\!\[([^\]]*)\]\(([^\)]+)\)", process_images, line)
-
-    if state.Links:
-        line = re.sub(r"\[([^\]]+)\]\(([^\)]+)\)", process_links, line)
-
-    line = re.sub(r"\[\^(\d+)\]:?", footnotes, line)
-
-    tokenList = re.finditer(r"((~~|\*\*_|_\*\*|\*{1,3}|_{1,3}|`+)|[^~_*`]+)", line)
-    result = ""
-
-    last_pos = 0
-    for match in tokenList:
-        if match.span()[0] > last_pos:
-            result += line[last_pos:match.span()[0]]
-
-        last_pos = match.span()[1]
-        token = re.sub(r'\s+',' ', match.group(1))
-        next_token = line[match.end()] if match.end() < len(line) else ""
-        prev_token = line[match.start()-1] if match.start() > 0 else ""
-
-        # This trick makes sure that things like `` ` `` render right.
-        if "`" in token and (not state.inline_code or state.inline_code == token):
-            if state.inline_code:
-                if ' ' in state.inline_code:
-                    savebrace()
-                state.inline_code = False
+            for line in self.read_lines(inp):
+                chunkList = self.parse_partial() if line is None else self.parse_line(line)
+                # arrange has its part of the bookkeeping to do
+                for _ in self.arrange(chunkList):
+                    pass
+                yield from drain()
+
+            for _ in self.release():
+                pass
+            yield from drain()
+            if held:
+                yield held
+        finally:
+            state.event_list = None
+            Style.Plaintext = plaintext
+
+    def render_events(self, inp, name = None):
+        """Writes what events() gives as JSON, one to a line. ``name`` is for
+        when there's more than one file, a file event with it goes first"""
+        import json
+        out = self.output or sys.stdout
+        # A stream gets them as they come, a file can go in bigger pieces
+        live = out.isatty() or self.state.is_pty
+        if name:
+            out.write(json.dumps({'type': 'file', 'name': name}) + "\n")
+        for event in self.events(inp):
+            out.write(json.dumps(event, ensure_ascii = False) + "\n")
+            if live:
+                out.flush()
+        out.flush()
+
+    def debug_write(self, text):
+        state = self.state
+        if state.Logging:
+            if state.Logging == True:
+                import tempfile
+                state.Logging = tempfile.NamedTemporaryFile(dir=gettmpdir(), prefix="dbg", delete=False, mode="wb")
+            state.Logging.write(text)
+
+    def savebrace(self):
+        state = self.state
+        if state.Savebrace and state.code_buffer_raw and os.name != 'nt':
+            path = os.path.join(gettmpdir(), 'savebrace')
+            with open(path, "a") as f:
+                state.code_buffer_raw.copy_to(f)
+                f.write("\x00")
+                f.flush()
+
+    def note(self, event_type, **fields):
+        # An event for events(), the callers check there's someone to hand it to first
+        self.state.event_list.append({'type': event_type, **fields})
+
+    def plain(self, text):
+        # What some inline markdown reads as. line_format keeps track of things like
+        # being in bold so that's put back to how it was
+        state = self.state
+        saved = state.inline_code, state.in_bold, state.in_italic, state.in_underline, state.in_strikeout
+        res = visible(self.line_format(text)).strip()
+        state.inline_code, state.in_bold, state.in_italic, state.in_underline, state.in_strikeout = saved
+        return res
+
+    def scir(self, line):
+        state = self.state
+        return strip_ansi(line) if state.block_depth > 0 else line
+
+    def format_table(self, rowList):
+        state, Style = self.state, self.Style
+        num_cols = len(rowList)
+        row_height = 0
+        wrapped_cellList = []
+
+        # Calculate max width per column (integer division)
+        # Subtract num_cols + 1 for the vertical borders '│'
+        available_width = state.current_width() - (num_cols * 2)
+
+        width_base = available_width // num_cols
+        width_mod  = available_width % num_cols
+
+        col_width_list = [width_base + (1 if i < width_mod else 0) for i in range(num_cols)]
+        is_head = state.in_table == Style.Head
+        state.bg = Style.TableHead[0] if is_head else Style.TableBody[0]
+
+        # First Pass: Wrap text and calculate row heights
+        # Note this is where every cell is formatted so if 
+        # you are styling, do it before here!
+        for ix in range(len(rowList)):
+            row = rowList[ix]
+            wrapped_cell = self.text_wrap(row, width=col_width_list[ix], force_truncate=True, preserve_format=True)
+
+            # Ensure at least one line, even for empty cells
+            if not wrapped_cell:
+                wrapped_cell = [""]
+
+            wrapped_cellList.append(wrapped_cell)
+            row_height = max(row_height, len(wrapped_cell))
+
+        # --- Second Pass: Format and emit rows ---
+        for ix in range(row_height):
+            # This is the fancy row separator
+            cell_bg, border = Style.TableHead if is_head else Style.TableLast if ix == row_height - 1 else Style.TableBody
+            line_segments = []
+
+            # Now we want to snatch this row index from all our cells
+            for iy in range(len(wrapped_cellList)):
+                cell = wrapped_cellList[iy]
+                segment = ''
+                if ix < len(cell):
+                    segment = cell[ix]
+
+                # Margin logic is correctly indented here
+                margin_needed = col_width_list[iy] - visible_length(segment)
+                margin_segment = segment + (" " * max(0, margin_needed))
+                line_segments.append(f"{cell_bg} {margin_segment}")
+
+            # Correct indentation: This should be outside the c_idx loop
+            joined_line = border.join(line_segments)
+            # Correct indentation and add missing characters
+            yield f"{state.space_left()}{Style.FgReset}{joined_line}{Style.Reset}"
+
+        state.bg = Style.BgReset
+
+    def emit_h(self, level, text):
+        state, Style = self.state, self.Style
+        text = self.line_format(text)
+        lineList = self.text_wrap(text)
+        res = []
+        pre, post = Style.HeadList[min(level, 6)]
+        for text in lineList:
+            space = state.space_left()
+            if level <= 2:      # and ## are centered
+                spaces_to_center = (state.current_width() -  visible_length(text)) / 2
+                right = ' ' * math.ceil(spaces_to_center) if level == 2 else ''
+                res.append(f"{space}\n{space}{pre}{' ' * math.floor(spaces_to_center)}{text}{right}{post}")
             else:
-                state.inline_code = token
-                state.code_buffer_raw = ''
-
-            if state.inline_code:
-                result += f'{BG}{Style.Mid}'
+                res.append(f"{space}{pre}{text}{post}")
+        return "\n".join(res)
+
+    def code_wrap(self, text_in):
+        state, Style = self.state, self.Style
+        if not Style.PrettyBroken and state.WidthWrap and len(text_in) > state.full_width():
+            return (0, [text_in])
+
+        # get the indentation of the first line
+        indent = len(text_in) - len(text_in.lstrip())
+        text = text_in.lstrip()
+        mywidth = state.full_width(-4 if Style.PrettyBroken else 0) - indent
+
+        # We take special care to preserve empty lines
+        if len(text) == 0:
+            return (0, [text_in])
+        res = [text[:mywidth]]
+
+        for i in range(mywidth, len(text), mywidth):
+            res.append(text[i : i + mywidth])
+
+        # sometimes just a newline wraps ... this isn't what we want actually
+        if res[-1].strip() == '':
+            res.pop()
+
+        return (indent, res)
+
+    def text_wrap(self, text, width = -1, indent = 0, first_line_prefix="", subsequent_line_prefix="", force_truncate=False, preserve_format=False):
+        state = self.state
+        if width == -1:
+            width = state.Width
+
+        # The empty word clears the buffer at the end.
+        formatted = self.line_format(text)
+        words = split_text(formatted) + [""]
+
+        lines = []
+        # We keep a running count of how wide the line is as words go on it so
+        # nothing gets measured more than once
+        current_line = ""
+        current_width = 0
+        # What the codes up to the end of the current line add up to, if there's been any
+        style = Sgr()
+        styled = False
+        resetter = "" if preserve_format else self.Style.FormatReset
+
+        # Printable ascii is as wide as it is long and has no codes or CJK in it, which is
+        # most of what there is to measure and all of it in plaintext
+        simple = formatted.isascii() and formatted.isprintable()
+        oldword = ''
+        for word in words:
+            if simple:
+                has_codes, word_width = False, len(word)
+            else:
+                has_codes = '\033' in word
+                word_width = visible_length(word)
+            if len(word) and current_width + word_width + 1 <= width:  # +1 for space
+                if simple:
+                    space = " " if current_line else ""
+                else:
+                    space = ""
+                    word_visible = visible(word) if has_codes else word
+                    if len(word_visible) > 0 and current_line:
+                        space = " "
+                    if cjk_count(oldword) and (":" in word_visible or cjk_count(word)):
+                        space = ""
+                current_line += space + word
+                current_width += len(space) + word_width
             else:
-                result += state.bg
-                state.code_buffer_raw = ''
-   
-        # This is important here because we ignore formatting
-        # inside of our code block.
-        elif state.inline_code:
-            result += token
-            state.code_buffer_raw += token
-
-        elif token == '~~' and (state.in_strikeout or not_text(prev_token)):
-            state.in_strikeout = not state.in_strikeout
-            result += STRIKEOUT[0] if state.in_strikeout else STRIKEOUT[1]
-
-        elif token in ['**_','_**','___','***'] and (state.in_bold or not_text(prev_token)):
-            state.in_bold = not state.in_bold
-            result += BOLD[0] if state.in_bold else BOLD[1]
-            state.in_italic = not state.in_italic
-            result += ITALIC[0] if state.in_italic else ITALIC[1]
-
-        elif (token == '__' or token == "**") and (state.in_bold or not_text(prev_token)):
-            state.in_bold = not state.in_bold
-            result += BOLD[0] if state.in_bold else BOLD[1]
- 
-        elif token == "*" and (state.in_italic or not_text(prev_token)):
-            # This is the use case of talking about * and then following
-            # up on something as opposed to *like this*.
-            if state.in_italic or (not state.in_italic and next_token != ' '):
+                # Word doesn't fit, finalize the previous line
+                prefix = first_line_prefix if not lines else subsequent_line_prefix
+                line_content = prefix + current_line  
+                line_width = visible_length(prefix) + current_width
+                if force_truncate and line_width >= width:
+                    line_content = truncate(line_content, width)
+                    line_width = visible_length(line_content)
+
+                margin = max(0, width - line_width)
+
+                if line_content.strip() != "":
+                    # We make absolutely positively sure beyond any doubt
+                    # that we have closed our hyperlink OSC
+                    if LINK[0] in line_content:
+                        line_content += LINK[1]
+                    lines.append(line_content + resetter + state.bg + ' ' * margin)
+
+                # and the next one starts out the same way
+                current_line = (" " * indent) + (style.reopen() if styled else '') + word
+                current_width = indent + word_width
+
+            if has_codes:
+                styled = True
+                for code in AnsiRe.findall(word):
+                    style.feed(code)
+
+            oldword = word
+
+        if len(lines) < 1:
+            return []
+
+        if len(lines) == 1:
+            lines[0] = lines[0].rstrip()
+
+        return lines
+
+    def line_format(self, line):
+        state, Style = self.state, self.Style
+        not_text = lambda token: not (token.isalnum() or token in ['\\','"']) or cjk_count(token)
+        footnotes = lambda match: ''.join([chr(SUPER[int(i)]) for i in match.group(1)])
+
+        def process_images(match):
+            # The image goes underneath the line it's on (see place_images)
+            url = match.group(2)
+            if Style.Plaintext:
+                return url
+            try:
+                path = image_path(url, ImageHeight)
+                if self.writer and self.writer.interactive and not (path and os.path.exists(path)):
+                    # This can take a while so the text keeps going and it gets painted in later
+                    state.image_list.append(Image(url, future=image_pool().submit(image_render, url, ImageHeight, path)))
+                else:
+                    state.image_list.append(Image(url, text=image_render(url, ImageHeight, path)))
+                return ''
+            except Exception:
+                return url
+
+        # Apply OSC 8 hyperlink formatting after other formatting
+        def process_links(match):
+            #import pdb
+            #pdb.set_trace()
+            #print(match)
+            description = match.group(1)
+            url = match.group(2)
+            if Style.Plaintext:
+                return description
+            return f'{LINK[0]}{url}\033\\{Style.Link}{description}{UNDERLINE[1]}{LINK[1]}{FGRESET}'
+
+        if not state.inline_code and not MarkupRe.search(line):
+            # Nothing in it is formatting so all there is to do is what's done to the text below
+            return SpaceRe.sub(' ', line)
+
+        if state.Images and '](' in line:
+            line = re.sub(r"\!\[([^\]]*)\]\(([^\)]+)\)", process_images, line)
+
+        if state.Links and '](' in line:
+            line = re.sub(r"\[([^\]]+)\]\(([^\)]+)\)", process_links, line)
+
+        if '[^' in line:
+            line = re.sub(r"\[\^(\d+)\]:?", footnotes, line)
+
+        tokenList = re.finditer(r"((~~|\*\*_|_\*\*|\*{1,3}|_{1,3}|`+)|[^~_*`]+)", line)
+        result = ""
+
+        last_pos = 0
+        for match in tokenList:
+            start, end = match.span()
+            if start > last_pos:
+                result += line[last_pos:start]
+
+            last_pos = end
+            token = match.group(1)
+            # Any whitespace but a single space isn't printable
+            if '  ' in token or not token.isprintable():
+                token = SpaceRe.sub(' ', token)
+
+            if match.group(2) is None and not state.inline_code:
+                # There's no markers in it, it's just text
+                result += token
+                continue
+
+            next_token = line[end] if end < len(line) else ""
+            prev_token = line[start-1] if start > 0 else ""
+
+            # This trick makes sure that things like `` ` `` render right.
+            if "`" in token and (not state.inline_code or state.inline_code == token):
+                if state.inline_code:
+                    if ' ' in state.inline_code:
+                        self.savebrace()
+                    state.inline_code = False
+                else:
+                    state.inline_code = token
+                    state.code_buffer_raw.clear()
+
+                if state.inline_code:
+                    result += Style.Inline
+                else:
+                    result += state.bg
+                    state.code_buffer_raw.clear()
+
+            # This is important here because we ignore formatting
+            # inside of our code block.
+            elif state.inline_code:
+                result += token
+                state.code_buffer_raw.write(token)
+
+            elif token == '~~' and (state.in_strikeout or not_text(prev_token)):
+                state.in_strikeout = not state.in_strikeout
+                result += Style.Strikeout[0] if state.in_strikeout else Style.Strikeout[1]
+
+            elif token in ['**_','_**','___','***'] and (state.in_bold or not_text(prev_token)):
+                state.in_bold = not state.in_bold
+                result += Style.Bold[0] if state.in_bold else Style.Bold[1]
                 state.in_italic = not state.in_italic
-                result += ITALIC[0] if state.in_italic else ITALIC[1]
+                result += Style.Italic[0] if state.in_italic else Style.Italic[1]
+
+            elif (token == '__' or token == "**") and (state.in_bold or not_text(prev_token)):
+                state.in_bold = not state.in_bold
+                result += Style.Bold[0] if state.in_bold else Style.Bold[1]
+
+            elif token == "*" and (state.in_italic or not_text(prev_token)):
+                # This is the use case of talking about * and then following
+                # up on something as opposed to *like this*.
+                if state.in_italic or (not state.in_italic and next_token != ' '):
+                    state.in_italic = not state.in_italic
+                    result += Style.Italic[0] if state.in_italic else Style.Italic[1]
+                else:
+                    result += token
+
+            elif token == "_" and (state.in_underline or (not_text(prev_token) and next_token.isalnum())):
+                state.in_underline = not state.in_underline
+                result += Style.Underline[0] if state.in_underline else Style.Underline[1]
             else:
                 result += token
 
-        elif token == "_" and (state.in_underline or (not_text(prev_token) and next_token.isalnum())):
-            state.in_underline = not state.in_underline
-            result += UNDERLINE[0] if state.in_underline else UNDERLINE[1]
-        else:
-            result += token
+        return result
+
+    def split_lines(self):
+        state = self.state
+        # Hand back every complete line sitting in the buffer and keep the
+        # remainder (a partial line, maybe a partial utf-8 sequence) for later
+        lineList = []
+        start = 0
+        with memoryview(state.buffer) as view:
+            ix = state.buffer.find(b'\n')
+            while ix != -1:
+                lineList.append(str(view[start:ix + 1], 'utf-8'))
+                start = ix + 1
+                ix = state.buffer.find(b'\n', start)
+
+        del state.buffer[:start]
+        return lineList
+
+    def partial_line(self):
+        state = self.state
+        # A multibyte character can straddle two reads so we only decode
+        # up to the last complete one
+        try:
+            return state.buffer.decode('utf-8')
+        except UnicodeDecodeError as ex:
+            return state.buffer[:ex.start].decode('utf-8')
+
+    def read_lines(self, stream):
+        state = self.state
+        TimeoutIx = 0
+        while True:
+            data = None
+            if state.is_pty or state.is_exec:
+                fdList = [fd for fd in [stream.fileno(), state.exec_master] if fd is not None]
+                ready_in, _, _ = select.select(fdList, [], [], 0)
+                if not ready_in:
+                    # Nothing is waiting for us so this is when the output goes out
+                    self.live_preview()
+                    self.flush_output()
+                    ready_in, _, _ = select.select(fdList, [], [], state.Timeout)
+
+                if state.is_exec: 
+                    # This is keyboard input
+                    if stream.fileno() in ready_in:
+                        data = os.read(stream.fileno(), ChunkSize)
+
+                        state.exec_kb += len(data)
+                        os.write(state.exec_master, data)
+
+                        if b'\n' in data or b'\r' in data:
+                            state.buffer.clear()
+                            self.flush_output()
+                            print("")
+                            state.exec_kb = 0
+                            data = b'\n'
+                        else:
+                            continue
 
-    return result
+                    if state.exec_master in ready_in:
+                        TimeoutIx = 0
+                        data = os.read(state.exec_master, ChunkSize)
 
-def parse(stream):
-    last_line_empty_cache = None
-    byte = None
-    TimeoutIx = 0
-    lexer = None
-    while True:
-        if state.is_pty or state.is_exec:
-            byte = None
-            ready_in, _, _ = select.select(
-                    [stream.fileno(), state.exec_master], [], [], state.Timeout)
-
-            if state.is_exec: 
-                # This is keyboard input
-                if stream.fileno() in ready_in:
-                    byte = os.read(stream.fileno(), 1)
-
-                    state.exec_kb += 1
-                    os.write(state.exec_master, byte)
-
-                    if byte in [b'\n', b'\r']:
-                        state.buffer = b''
-                        print("")
-                        state.exec_kb = 0
-                    else:
-                        continue
+                        if state.exec_kb:
+                            self.flush_output()
+                            os.write(sys.stdout.fileno(), data)
 
-                if state.exec_master in ready_in:
-                    TimeoutIx = 0
-                    byte = os.read(state.exec_master, 1)
+                    if len(ready_in) == 0:
+                        TimeoutIx += 1
 
-                    if state.exec_kb:
-                        os.write(sys.stdout.fileno(), byte)
+                elif stream.fileno() in ready_in: 
+                    data = os.read(stream.fileno(), ChunkSize)
+                    TimeoutIx = 0
 
-                if len(ready_in) == 0:
+                elif TimeoutIx == 0:
+                    # This is our record separator for debugging - hands peaking
+                    self.debug_write("🫣".encode('utf-8'))
                     TimeoutIx += 1
 
-            elif stream.fileno() in ready_in: 
-                byte = os.read(stream.fileno(), 1)
-                TimeoutIx = 0
-
-            elif TimeoutIx == 0:
-                # This is our record separator for debugging - hands peaking
-                debug_write("🫣".encode('utf-8'))
-                TimeoutIx += 1
+            else:
+                data = read_chunk(stream)
 
-        else:
-            byte = stream.read(1)
+            # We timed out, the parser gets to look at the incomplete line
+            if data is None:
+                yield None
+                continue
 
-        if byte is not None:
             # This is the eol
-            if byte == b'': 
+            if data == b'': 
                 if len(state.buffer) == 0:
-                    break
-                else:
-                    byte = b'\n'
+                    return
+                data = b'\n'
+
+            state.buffer += data
+            self.debug_write(data)
+            yield from self.split_lines()
+
+    def lex_line(self, lexer, line):
+        from pygments.lexer import RegexLexer, ExtendedRegexLexer, LexerContext
+        state = self.state
+        # Lexing the whole block again for every line is quadratic so instead we carry the
+        # lexer state over from the previous line (state.code_checkpoint) and only lex the new one.
+        # Lexers that do more on the way out than the regexes (php's builtins, elixir's
+        # keywords, yaml's indents in its own context ...) can't be handed the state to
+        # start from. Those get the whole block so far lexed again every line like it
+        # used to be, which is quadratic but has their colors.
+        code = type(lexer).get_tokens_unprocessed.__code__
+        base = ExtendedRegexLexer if isinstance(lexer, ExtendedRegexLexer) else RegexLexer
+        rewrites = code is not base.get_tokens_unprocessed.__code__
+
+        if isinstance(lexer, RegexLexer) and rewrites and 'stack' not in code.co_varnames[:code.co_argcount]:
+            carry = state.code_carry
+            tokenList = list(lexer.get_tokens_unprocessed(carry + line))
+            state.code_carry = carry + line
+
+        elif isinstance(lexer, ExtendedRegexLexer):
+            # These keep everything in the context object, including things like ruby heredocs
+            if state.code_checkpoint is None:
+                state.code_checkpoint = LexerContext(line, 0)
+            ctx = state.code_checkpoint
+            ctx.text, ctx.pos, ctx.end = line, 0, len(line)
+            tokenList = list(lexer.get_tokens_unprocessed(context=ctx))
+            carry = ''
+
+        elif isinstance(lexer, RegexLexer) and token_type() and hasattr(lexer, '_tokens'):
+            # Some rules (C's /* */, a setext header, <script> ...) are a single regex over many
+            # lines. So we keep the text from the start of the line the last token started on
+            # (state.code_carry) and lex it again with the next line, starting from the state
+            # it had there.
+            carry = state.code_carry
+            text = carry + line
+            stack = state.code_checkpoint or ['root']
+            tokenList, endstack, (resume, resumestack) = regex_lex(lexer, text, stack)
+
+            # The ones that rewrite tokens and let us hand them the stack get to
+            if rewrites:
+                tokenList = list(lexer.get_tokens_unprocessed(text, stack))
+
+            state.code_carry, state.code_checkpoint = text[resume:], resumestack
+            if state.code_carry.count('\n') > CodeCarry:
+                # We give up on it, it's probably not coming back
+                state.code_carry, state.code_checkpoint = '', endstack
 
-            state.buffer += byte
-            debug_write(byte)
+        else:
+            # Hand-written lexers don't have a state we can grab, these go line by line
+            tokenList = list(lexer.get_tokens_unprocessed(line))
+            carry = ''
 
-        if not (byte == b'\n' or byte is None): continue
+        state.code_gen += len(line)
+        return clip_tokens([(ttype, value) for _, ttype, value in tokenList], len(carry))
 
-        line = state.buffer.decode('utf-8').replace('\t','  ')
+    def parse(self, stream):
+        for line in self.read_lines(stream):
+            if line is None:
+                yield from self.parse_partial()
+            else:
+                yield from self.parse_line(line)
+
+    def parse_partial(self):
+        # The incomplete line may be a prompt, in which case it's
+        # ours now and gets taken out of the buffer
+        line = self.partial_line()
+        if len(line):
+            yield from self.parse_line(line)
+            if self.state.maybe_prompt:
+                del self.state.buffer[:len(line.encode('utf-8'))]
+
+    def parse_line(self, line):
+        state, Style = self.state, self.Style
+        line = line.replace('\t','  ')
         state.has_newline = line.endswith('\n')
 
         state.maybe_prompt = not state.has_newline and state.current()['none'] and re.match(state.prompt_regex, visible(line))
@@ -751,12 +1489,10 @@ def parse(stream):
             state.emit_flag = Code.Flush
             yield line
             state.current_line = ''
-            state.buffer = b''
 
         if not state.has_newline:
-            continue
+            return
 
-        state.buffer = b''
         """
         # Run through the plugins first
         res = latex.Plugin(line, state, Style)
@@ -769,18 +1505,18 @@ def parse(stream):
                 yield row
                 continue
         """
-        
+
         # running this here avoids stray |
-        # So kimi doesn't newline after the <think> token and it uses some unicode triangle?. They'll 
-        # newline at the end of it, but not the beginning.
-        block_match = re.match(r"^\s*((>\s*)+|[◁<].?think[>▷])(.*)", line)
-        if not state.in_code and block_match:
+        shape, shape_line = classify(line), line
+        block = (state.block_depth, state.block_type)
+        if not state.in_code and shape.kind == Line.Block:
+            block_match = shape.match
             # wtf is this you might ask! Not all thinking models use < and > ...
             # because why make life easy?
             if block_match.group(1)[1:7] == '/think':
                 line = ''
                 state.block_depth = 0
-                yield RESET
+                yield Style.Reset
             elif block_match.group(1)[1:6] == 'think':
                 line = block_match.group(3)
                 state.block_depth = 1
@@ -792,23 +1528,31 @@ def parse(stream):
                 line = line[len(block_match.group(1)):]
         else:
             if state.block_type == '>' and state.block_depth > 0:
-                yield FGRESET
+                yield Style.FgReset
                 state.block_depth = 0
 
+        if state.event_list is not None and block != (state.block_depth, state.block_type):
+            if block[0]:
+                self.note('quote_end', kind = block[1])
+            if state.block_depth:
+                self.note('quote_start', kind = state.block_type, depth = state.block_depth)
+
         # Collapse Multiple Empty Lines if not in code blocks
         if not state.in_code:
             is_empty = line.strip() == ""
 
             if is_empty and state.last_line_empty:
-                continue  # Skip processing this line
+                return  # Skip processing this line
             elif is_empty:
                 state.last_line_empty = True
+                if state.event_list is not None:
+                    self.note('blank')
                 yield state.space_left()
-                continue
+                return
             else:
-                last_line_empty_cache = state.last_line_empty
+                state.last_line_empty_cache = state.last_line_empty
                 state.last_line_empty = False
-        
+
         # This is to reset our top-level line-based systems
         # \n buffer
         if not state.in_list and len(state.ordered_list_numbers) > 0:
@@ -824,33 +1568,39 @@ def parse(stream):
         else:
             logging.debug("Indentation decreased from first line.")
 
+        # The blockquote or the indent may have changed what we're looking at
+        if shape.kind == Line.Block or line is not shape_line:
+            shape = classify(line, quotes = False)
 
         # Indent guaranteed
 
         # in order to stream tables and keep track of the headers we need to know whether
         # we are in table or not table otherwise > 1 tables won't have a stylized header
-        if state.in_table and not state.in_code and not re.match(r"^\s*\|.+\|\s*$", line):
+        if state.in_table and not state.in_code and shape.kind != Line.Table:
             state.in_table = False
 
         # <code><pre>
         if not state.in_code:
-            code_match = re.match(r"^\s*(```|<pre>)\s*([^\s]+|$)\s*$", line)
-            if code_match:
+            if shape.kind == Line.Fence:
                 state.in_code = Code.Backtick
-                state.code_indent = len(line) - len(line.lstrip())
-                state.code_language = code_match.group(2) or 'Bash'
+                state.code_indent = shape.indent
+                state.code_language = shape.match.group(2) or 'Bash'
 
-            elif state.CodeSpaces and last_line_empty_cache and not state.in_list:
+            elif state.CodeSpaces and state.last_line_empty_cache and not state.in_list:
                 code_match = re.match(r"^    \s*[^\s\*]", line)
                 if code_match:
                     state.in_code = Code.Spaces
                     state.code_language = 'Bash'
 
             if state.in_code:
-                state.code_buffer = state.code_buffer_raw = ""
+                if state.event_list is not None:
+                    self.note('code_start', language = state.code_language)
+                state.code_buffer_raw.clear()
+                state.code_checkpoint = None
+                state.code_carry = ''
                 state.code_gen = 0
                 state.code_first_line = True
-                state.bg = f"{BG}{Style.Dark}"
+                state.bg = Style.Codebg
                 state.where_from = "code pad"
                 if Style.PrettyPad or Style.PrettyBroken:
                     if not Style.PrettyPad:
@@ -863,7 +1613,7 @@ def parse(stream):
                 logging.debug(f"In code: ({state.in_code})")
 
                 if state.in_code == Code.Backtick:
-                    continue
+                    return
 
         if state.in_code:
             try:
@@ -873,20 +1623,23 @@ def parse(stream):
                     if state.scrape:
                         ext = "sh"
                         try:
-                            ext = get_lexer_by_name(state.code_language).filenames[0].split('.')[-1]
+                            ext = get_lexer(state.code_language)[0].filenames[0].split('.')[-1]
                         except:
                             logging.warning(f"Can't find canonical extension for {state.code_language}")
                             pass
 
-                        open(os.path.join(state.scrape, f"file_{state.scrape_ix}.{ext}"), 'w').write(state.code_buffer_raw)
+                        with open(os.path.join(state.scrape, f"file_{state.scrape_ix}.{ext}"), 'w') as f:
+                            state.code_buffer_raw.copy_to(f)
                         state.scrape_ix += 1
 
-                    savebrace()
+                    self.savebrace()
+                    if state.event_list is not None:
+                        self.note('code_end', language = state.code_language, text = state.code_buffer_raw.getvalue())
                     state.code_language = None
                     state.code_indent = 0
                     code_type = state.in_code
                     state.in_code = False
-                    state.bg = BGRESET
+                    state.bg = Style.BgReset
 
                     state.where_from = "code pad"
                     if Style.PrettyPad or Style.PrettyBroken:
@@ -895,7 +1648,7 @@ def parse(stream):
                             yield ""
 
                     else:
-                        yield RESET
+                        yield Style.Reset
 
                     logging.debug(f"code: {state.in_code}")
                     state.emit_flush = True
@@ -904,23 +1657,28 @@ def parse(stream):
                     #yield RESET
 
                     if code_type == Code.Backtick:
-                        continue
+                        return
                     else:
                         # otherwise we don't want to consume
                         # nor do we want to be here.
                         raise Goto()
 
-                if state.code_first_line or lexer is None:
+                if Style.Plaintext:
+                    # There's nothing to color so there's no lexer, the code goes out as it is
+                    if line.startswith(' ' * state.code_indent):
+                        line = line[state.code_indent :]
+
+                elif state.code_first_line or state.code_lexer is None:
                     state.code_first_line = False
+                    import pygments.util
+                    state.code_lexer, known = get_lexer(state.code_language)
                     try:
-                        lexer = get_lexer_by_name(state.code_language)
-                        custom_style = override_background(Style.Syntax, ansi2hex(Style.Dark))
+                        state.code_formatter = get_formatter(Style.Syntax if known else "default", ansi2hex(Style.Dark))
                     except pygments.util.ClassNotFound as e:
                         logging.debug(e)
-                        lexer = get_lexer_by_name("Bash")
-                        custom_style = override_background("default", ansi2hex(Style.Dark))
+                        state.code_lexer = get_lexer("Bash")[0]
+                        state.code_formatter = get_formatter("default", ansi2hex(Style.Dark))
 
-                    formatter = TerminalTrueColorFormatter(style=custom_style)
                     if line.startswith(' ' * state.code_indent):
                         line = line[state.code_indent :]
 
@@ -929,99 +1687,62 @@ def parse(stream):
 
                 # By now we have the properly stripped code line
                 # in the line variable. Add it to the buffer.
-                state.code_buffer_raw += line
+                state.code_buffer_raw.write(line)
                 state.code_line += line
                 if state.code_line.endswith('\n'):
                     line = state.code_line
                     state.code_line = ''
                 else:
-                    continue
+                    return
+
+                if state.event_list is not None:
+                    self.note('code_line', text = line)
+
+                tokenList = None if Style.Plaintext else self.lex_line(state.code_lexer, line)
+                indent, line_wrap = self.code_wrap(line)
 
-                highlighted_code = highlight(line, lexer, formatter)
-                indent, line_wrap = code_wrap(line)
-                
                 state.where_from = "in code"
                 pre = [state.space_left(listwidth = True), '  '] if Style.PrettyBroken else ['', '']
 
+                # The wrapped pieces come from the line without its indentation. Each piece gets
+                # its surrounding whitespace trimmed (the indent is put back on below)
+                offset = indent
                 for tline in line_wrap:
-                    # wrap-around is a bunch of tricks. We essentially format longer and longer portions of code. The problem is
-                    # the length can change based on look-ahead context so we need to use our expected place (state.code_gen) and
-                    # then naively search back until our visible_lengths() match. This is not fast and there's certainly smarter
-                    # ways of doing it but this thing is way trickery than you think
-                    highlighted_code = highlight(state.code_buffer + tline, lexer, formatter)
-                    #print("(",bytes(highlighted_code,'utf-8'),")")
-                    parts = split_up(highlighted_code)
-
-                    # Sometimes the highlighter will do things like a full reset or a background reset.
-                    # This is mostly not what we want
-                    parts = [ re.sub(r"\033\[[34]9(;00|)m", FORMATRESET, x) for x in parts]
-    
-                    # Since we are streaming we ignore the resets and newlines at the end
-                    while parts[-1] in [FGRESET, FORMATRESET]:
-                        parts.pop()
-
-                    tline_len = visible_length(tline.rstrip('\r\n'))
-
-                    # now we find the new stuff:
-                    ttl = 0
-                    for i in range(len(parts)-1, 0, -1):
-                        idx = parts[i]
-                        if len(idx) == 0:
-                            continue
-
-                        ttl += len(idx) if idx[0] != '\x1b' else 0
-
-                        if ttl > tline_len:
-                            break
-
-
-                    newlen = visible_length("".join(parts[i:]))
-
-                    snipfrom = newlen - len(tline) + 2
-                    # this is all getting replaced with the new lexer so let's give a cheap
-                    # fix for now:
-                    if snipfrom == 1:
-                        snipfrom = 0
-
-                    if snipfrom > 0:
-                        parts[i] = parts[i][snipfrom:]
-
-                    state.code_buffer += tline
-                    this_batch = "".join(parts[i:])
-
-                    if this_batch.startswith(FGRESET):
-                        this_batch = this_batch[len(FGRESET) :]
-
-                    # clean it before prepending with potential format 
-                    this_batch = this_batch.strip()
-                    while i - 1 >= 0 and parts[i-1] and parts[i-1][0] == '\x1b':
-                         this_batch = parts[i-1] + this_batch
-                         i -= 1
+                    start = offset + len(tline) - len(tline.lstrip())
+                    end = offset + len(tline.rstrip())
+                    offset += len(tline)
+                    if tokenList is None:
+                        this_batch = line[start:end]
+                    else:
+                        highlighted_code = highlight_tokens(tokenList, start, end, state.code_formatter)
 
-                    ## this is the crucial counter that will determine
-                    # the beginning of the next line
-                    state.code_gen = len(highlighted_code)
-                    code_line = ' ' * indent + this_batch.strip()
+                        # Sometimes the highlighter will do things like a full reset or a background reset.
+                        # This is mostly not what we want
+                        this_batch = CodeResetRe.sub(FORMATRESET, highlighted_code)
+                    code_line = ' ' * indent + this_batch
 
-                    margin = state.full_width( -len(pre[1]) ) - visible_length(code_line) % state.WidthFull
-                    yield f"{pre[0]}{Style.Codebg}{pre[1]}{code_line}{FORMATRESET}{' ' * max(0, margin)}{BGRESET}"  
-                continue
+                    # The background runs out to the edge, without one the spaces would only come off again
+                    margin = 0 if Style.Plaintext else state.full_width( -len(pre[1]) ) - visible_length(code_line) % state.WidthFull
+                    yield f"{pre[0]}{Style.Codebg}{pre[1]}{code_line}{Style.FormatReset}{' ' * max(0, margin)}{Style.BgReset}"
+                return
             except Goto:
                 pass
-            
+
             except Exception as ex:
                 logging.warning(f"Code parsing error: {ex}")
                 traceback.print_exc()
                 pass
 
         # <table>
-        if re.match(r"^\s*\|.+\|\s*$", line) and not state.in_code:
+        if shape.kind == Line.Table and not state.in_code:
             cells = [c.strip() for c in line.strip().strip("|").split("|")]
 
             # This guarantees we are at the first line
             # \n buffer
             if not state.in_table:
                 state.in_table = Style.Head
+                if state.event_list is not None:
+                    self.note('table_row', header = True, cells = [self.plain(cell) for cell in cells])
 
             elif state.in_table == Style.Head:
                 # we ignore the separator, this is just a check
@@ -1031,17 +1752,19 @@ def parse(stream):
                 # Let's assume everything worked out I guess.
                 # We set our header to false and basically say we are expecting the body
                 state.in_table = Code.Body 
-                continue
+                return
 
-            yield from format_table(cells)
-            continue
+            elif state.event_list is not None:
+                self.note('table_row', header = False, cells = [self.plain(cell) for cell in cells])
+
+            yield from self.format_table(cells)
+            return
 
         # <li> <ul> <ol>
-        # llama-4 maverick uses + and +- for lists ... for some reason
         content = line
         bullet = ' '
-        list_item_match = re.match(r"^(\s*)([\+*\-] |\+\-+|\d+\.\s+)(.*)", line)
-        if list_item_match:
+        if shape.kind == Line.Item:
+            list_item_match = shape.match
             # llama 4 maverick does this weird output like this
             # 1. blah blah blah
             #    this should be a list
@@ -1056,7 +1779,7 @@ def parse(stream):
             state.list_indent_text = len(list_item_match.group(2)) - 1
             state.in_list = True
 
-            indent = len(list_item_match.group(1))
+            indent = shape.indent
 
             list_type = "number" if list_item_match.group(2)[0].isdigit() else "bullet"
             content = list_item_match.group(3)
@@ -1082,40 +1805,53 @@ def parse(stream):
                 list_number = int(max(state.ordered_list_numbers[-1], float(list_item_match.group(2))))
                 bullet = str(list_number)
 
+            if state.event_list is not None:
+                self.note('item', depth = len(state.list_item_stack), number = list_number if list_type == "number" else None, text = self.plain(content))
+
+        elif state.in_list and state.event_list is not None:
+            self.note('text', depth = len(state.list_item_stack), text = self.plain(content))
+
         # This is intentional ... we can get here in llama 4 using
         # a weird thing
         if state.in_list:
             indent = (len(state.list_item_stack) - 1) * Style.ListIndent #+ (len(bullet) - 1)
             wrap_width = state.current_width(listwidth = True) - Style.ListIndent
-            
-            wrapped_lineList = text_wrap(content, wrap_width, Style.ListIndent,
-                first_line_prefix = f"{(' ' * indent)}{FG}{Style.Symbol}{bullet}{RESET} ",
+
+            wrapped_lineList = self.text_wrap(content, wrap_width, Style.ListIndent,
+                first_line_prefix = f"{(' ' * indent)}{Style.Bullet}{bullet}{Style.Reset} ",
                 subsequent_line_prefix = " " * (indent)
             )
             for wrapped_line in wrapped_lineList:
-                yield f"{state.space_left()}{scir(wrapped_line)}\n"
+                yield f"{state.space_left()}{self.scir(wrapped_line)}\n"
 
-            continue
+            return
 
         # <h1> ... <h6>
-        header_match = re.match(r"^\s*(#{1,6})\s*(.*)", line)
-        if header_match:
+        if shape.kind == Line.Header:
+            header_match = shape.match
             level = len(header_match.group(1))
-            yield emit_h(level, header_match.group(2))
-            continue
+            if state.event_list is not None:
+                self.note('header', level = level, text = self.plain(header_match.group(2)))
+            yield self.emit_h(level, header_match.group(2))
+            return
 
         # <hr>
-        hr_match = re.match(r"^[\s]*([-\*=_]){3,}[\s]*$", line)
-        if hr_match:
-            if state.last_line_empty or last_line_empty_cache:
+        if shape.kind == Line.Rule:
+            hr_match = shape.match
+            if state.last_line_empty or state.last_line_empty_cache:
                 # print a horizontal rule using a unicode midline 
-                yield f"{Style.MarginSpaces}{FG}{Style.Symbol}{'─' * state.Width}{RESET}"
+                if state.event_list is not None:
+                    self.note('rule')
+                yield Style.Rule
             else:
                 # We tell the next level up that the beginning of the buffer should be a flag.
                 # Underneath this condition it will no longer yield
                 state.emit_flag = 1 if '-' in hr_match.groups(1) else 2
+                if state.event_list is not None:
+                    # emit_flag has them the other way around, an underline of = is the <h1>
+                    self.note('setext', level = 2 if hr_match.group(1) == '-' else 1)
                 yield ""
-            continue
+            return
 
         state.where_from = "emit_normal"
 
@@ -1123,112 +1859,690 @@ def parse(stream):
         # be empty. This is a hack.
         state.list_item_stack = []
 
+        if state.event_list is not None:
+            self.note('text', text = self.plain(line))
+
         if len(line) == 0: yield ""
         if visible_length(line) < state.Width:
             # we want to prevent word wrap
-            yield f"{state.space_left()}{line_format(line.lstrip())}"
+            yield f"{state.space_left()}{self.line_format(line.lstrip())}"
         else:
-            wrapped_lines = text_wrap(line)
+            wrapped_lines = self.text_wrap(line)
             for wrapped_line in wrapped_lines:
                 yield f"{state.space_left()}{wrapped_line}\n"
 
-def terminal_prep(what):
-    if Style.Plaintext:
-        line = "\n".join([x.rstrip() for x in strip_ansi(what).split("\n")])
-        if len(line.strip()) == 0:
-          return ""
-        return line
-    return what
-
-def emit(inp):
-    buffer = []
-    flush = False
-    for chunk in parse(inp):
-        width_calc()
-        if state.emit_flag:
-            if state.emit_flag == Code.Flush:
-                flush = True
-                state.emit_flag = None
+    def terminal_prep(self, what):
+        Style = self.Style
+        if Style.Plaintext:
+            if '\033' in what:
+                what = strip_ansi(what)
+            line = "\n".join([x.rstrip() for x in what.split("\n")])
+            if len(line.strip()) == 0:
+              return ""
+            return line
+        return what
+
+    def arrange(self, chunks):
+        # This runs what the parser yields through the last bits of layout. We hold one
+        # chunk back since the line after it can turn it into a header (see emit_flag)
+        state = self.state
+        for chunk in chunks:
+            self.width_calc()
+            flush = False
+            if state.emit_flag:
+                if state.emit_flag == Code.Flush:
+                    flush = True
+                    state.emit_flag = None
+                elif state.emit_buffer:
+                    state.emit_buffer[0] = self.emit_h(state.emit_flag, state.emit_buffer[0])
+                    state.emit_flag = None
+                    continue
+                else:
+                    # Everything before it has gone out already (say it's the start of
+                    # another render) so there's nothing to make a header of, it's a rule
+                    state.emit_flag = None
+                    chunk = self.Style.Rule
+
+            if not state.has_newline:
+                chunk = chunk.rstrip("\n")
+            elif not chunk.endswith("\n"):
+                chunk += "\n"
+
+            if state.image_list:
+                chunk = self.place_images(chunk)
+
+            if chunk.endswith("\n"):
+                state.current_line = ''
             else:
-                buffer[0] = emit_h(state.emit_flag, buffer[0])
-                state.emit_flag = None
+                state.current_line += chunk
+
+            state.emit_buffer.append(chunk)
+            # This *might* be dangerous
+            state.reset_inline()
+
+            if flush:
+                chunk = "\n".join(state.emit_buffer)
+                state.emit_buffer = []
+
+            elif len(state.emit_buffer) == 1:
                 continue
 
-        if not state.has_newline:
-            chunk = chunk.rstrip("\n")
-        elif not chunk.endswith("\n"):
+            else:
+                chunk = state.emit_buffer.pop(0)
+
+            yield self.terminal_prep(chunk)
+
+    def place_images(self, chunk):
+        # The images from a line go underneath it. The ones still being rendered get a
+        # placeholder as tall as they'll be, with the url on top, which they're painted over
+        state, Style = self.state, self.Style
+        if not chunk.endswith("\n"):
             chunk += "\n"
 
-        if chunk.endswith("\n"):
-            state.current_line = ''
+        for image in state.image_list:
+            if image.future:
+                image.mark = f"{Style.MarginSpaces}{FG}{Style.Grey}{image.url}{FGRESET}"
+                chunk += image.mark + "\n" * ImageHeight
+                state.image_pending.append(image)
+            else:
+                chunk += image.text + "\n"
+
+        state.image_list = []
+        return chunk
+
+    def write_chunk(self, chunk):
+        # Notes down where the placeholders in this chunk are going before it goes
+        state, writer = self.state, self.writer
+        if state.live_rowList:
+            # The real thing goes where the preview was
+            self.live_draw([])
+        state.live_key = None
+        if chunk:
+            state.line_done = chunk.endswith('\n')
+
+        pos = 0
+        for image in state.image_pending:
+            if image.row is None:
+                ix = chunk.find(image.mark, pos)
+                if ix == -1:
+                    break
+                image.row = writer.rows + chunk.count("\n", 0, ix)
+                pos = ix + len(image.mark)
+
+        writer.write(chunk)
+        if state.image_pending:
+            self.paint_images()
+
+    def paint_images(self, wait = False):
+        # The images that are done get drawn over their placeholders, as long as those are still
+        # on the screen. The cursor is saved and put back so the stream carries on where it was
+        state, writer = self.state, self.writer
+        if wait:
+            from concurrent.futures import wait as wait_for
+            wait_for([image.future for image in state.image_pending if image.row is not None], timeout=ImageWait)
+
+        pendingList = []
+        for image in state.image_pending:
+            if image.row is None or not image.future.done():
+                pendingList.append(image)
+                continue
+
+            try:
+                text = image.future.result()
+            except Exception:
+                # The url is all they get
+                continue
+
+            # The cursor is at the end of the live preview if there is one
+            up = writer.rows - image.row + max(0, len(state.live_rowList) - 1)
+            if up < shutil.get_terminal_size().lines:
+                # A "next line" rather than a newline so the screen can't scroll out from under us
+                writer.write(f"\0337\033[{up}F" + text.replace("\n", "\033[1E") + "\0338")
+
+        state.image_pending = [] if wait else pendingList
+
+    def live_safe(self, line):
+        # Prose, lists, headers and quotes can be laid out early and then thrown away. Code,
+        # tables, rules and images touch more than the parse state so they wait for the newline
+        state = self.state
+        if not line.strip() or len(line) > LiveMax or '![' in line:
+            return False
+        if not state.line_done or state.current_line or state.in_code or state.in_table or state.emit_flag:
+            return False
+        if state.CodeSpaces and line.startswith('    '):
+            return False
+        return classify(line).kind not in (Line.Fence, Line.Table, Line.Rule)
+
+    def live_preview(self):
+        # The Live feature. The incomplete line gets laid out as if its newline had come,
+        # on a copy of the state that's put back after, and drawn under what's gone out
+        # along with the chunk arrange is holding back. It's redrawn as the line grows
+        # and cleared away when the real thing is written.
+        state = self.state
+        if not (state.Live and self.writer and self.writer.interactive) or state.is_exec or self.Style.Plaintext:
+            return
+
+        line = self.partial_line()
+        key = (line, len(state.emit_buffer), state.WidthFull)
+        if key == state.live_key:
+            return
+        state.live_key = key
+
+        rowList = []
+        if self.live_safe(line):
+            saved = dict(state.__dict__)
+            for name in ('ordered_list_numbers', 'list_item_stack', 'image_list'):
+                saved[name] = list(saved[name])
+            try:
+                chunkList = list(state.emit_buffer) + list(self.parse_line(line + '\n'))
+            finally:
+                state.__dict__.update(saved)
+
+            # Every chunk is a line of its own, the way arrange has it
+            text = ''.join(chunk if chunk.endswith('\n') else chunk + '\n' for chunk in chunkList)
+            rowList = text.split('\n')[:-1]
+            size = shutil.get_terminal_size()
+            if len(rowList) >= size.lines or any(visible_length(row) > size.columns for row in rowList):
+                # Either there'd be no way back up to the top of it or the terminal would
+                # wrap rows on its own and we'd lose count of them
+                rowList = []
+
+        self.live_draw(rowList)
+
+    def live_draw(self, rowList):
+        # Only what changed is drawn again, which for a paragraph coming in a few words at
+        # a time is the last row. The cursor stays at the end of the last row
+        state, writer = self.state, self.writer
+        oldList = state.live_rowList
+        ix = 0
+        while ix < min(len(oldList), len(rowList)) and oldList[ix] == rowList[ix]:
+            ix += 1
+        if ix == len(oldList) == len(rowList):
+            return
+
+        if not oldList:
+            out = ''
+        elif ix == len(oldList):
+            out = '\n'
         else:
-            state.current_line += chunk
-            
-        buffer.append(chunk)
-        # This *might* be dangerous
-        state.reset_inline()
+            up = len(oldList) - 1 - ix
+            out = (f"\033[{up}F" if up else "\r") + "\033[J"
+
+        if rowList[ix:]:
+            out += '\n'.join(rowList[ix:]) + FORMATRESET
+
+        writer.write(out)
+        # None of it is there to stay so it doesn't count as rows that went out
+        writer.rows -= out.count('\n')
+        state.live_rowList = rowList
+
+    def release(self):
+        # At the end of the stream there's nothing left that can change the chunk we held back
+        if len(self.state.emit_buffer):
+            yield self.terminal_prep(self.state.emit_buffer.pop(0))
+
+    def parse_buffer(self):
+        for line in self.split_lines():
+            yield from self.parse_line(line)
+
+    def flush_output(self):
+        if self.writer:
+            if self.state.image_pending:
+                self.paint_images()
+            self.writer.flush()
+
+    def emit(self, inp):
+        self.writer = BatchWriter(self.output or sys.stdout, self.state.Latency)
+        try:
+            for chunk in self.arrange(self.parse(inp)):
+                self.write_chunk(chunk)
+
+            for chunk in self.release():
+                self.write_chunk(chunk)
+
+            if self.state.image_pending:
+                self.writer.flush()
+                self.paint_images(wait = True)
+        finally:
+            self.writer.flush()
+            self.writer = None
+
+    def feed(self, data):
+        """Push more input in and get back what's been rendered because of it.
+
+        ``data`` can be any slice of the stream (str or utf-8 bytes), say the
+        token deltas from an LLM client. Nothing is read or written here, the
+        rendered ANSI chunks are returned in order. Text that can't be laid out
+        until more arrives (an incomplete line for instance) is held on to.
+        """
+        if not self._setup:
+            self.setup()
 
-        if flush:
-            chunk = "\n".join(buffer)
-            buffer = []
-            flush = False
+        if isinstance(data, str):
+            data = data.encode('utf-8')
 
-        elif len(buffer) == 1:
-            continue
+        self.state.buffer += data
+        self.debug_write(data)
+        return list(self.arrange(self.parse_buffer()))
 
-        else:
-            chunk = buffer.pop(0)
+    def flush(self):
+        """End the stream and return whatever was still being held back."""
+        if len(self.state.buffer):
+            self.state.buffer += b'\n'
 
-        print(terminal_prep(chunk), end="", file=sys.stdout, flush=True)
+        return list(self.arrange(self.parse_buffer())) + list(self.release())
 
-    if len(buffer):
-        print(terminal_prep(buffer.pop(0)), file=sys.stdout, end="", flush=True)
+    async def render_async(self, source):
+        """Render an async iterator of text (or bytes) into an async iterator of ANSI chunks.
 
-def ansi2hex(ansi_code):
-    parts = ansi_code.strip('m').split(";")
-    r, g, b = map(int, parts)
-    return f"#{r:02x}{g:02x}{b:02x}"
+        This is feed() and flush() driven by the event loop. When the source goes quiet
+        for the ``Timeout`` feature the incomplete line is checked for a prompt, the way
+        the select() loop does it, so an interactive stream doesn't sit there waiting.
+        """
+        import asyncio
+        if not self._setup:
+            self.setup()
 
-def apply_multipliers(style, name, H, S, V):
-    m = style.get(name)
-    r, g, b = colorsys.hsv_to_rgb(min(1.0, H * m["H"]), min(1.0, S * m["S"]), min(1.0, V * m["V"]))
-    return ';'.join([str(int(x * 255)) for x in [r, g, b]]) + "m"
+        source = source.__aiter__()
+        pending = None
+        TimeoutIx = 0
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(source.__anext__())
+
+                done, _ = await asyncio.wait([pending], timeout=self.state.Timeout)
+                if not done:
+                    if TimeoutIx == 0:
+                        self.debug_write("🫣".encode('utf-8'))
+                    TimeoutIx += 1
 
-def width_calc():
-    if state.WidthArg:
-       width = state.WidthArg
-    else:
-       try:
-           width = shutil.get_terminal_size().columns
-           state.WidthWrap = True
-       except (AttributeError, OSError):
-           # this means it's a pager, we can just ignore the base64 clipboard
-           width = 80
-           pass
-
-
-    # This can't be done because our list item stack can change as well so
-    # unless we want to track that too, we're SOL
-    #if state.WidthFull == width:
-    #    return
-
-    state.WidthFull = width
-
-    state.Width = state.WidthFull - 2 * Style.Margin
-    pre = state.space_left(listwidth=True) if Style.PrettyBroken else ''
-    design  = [FG, '▄','▀'] if Style.PrettyPad else [BG, ' ',' ']
-    Style.Codepad = [
-        f"{pre}{RESET}{design[0]}{Style.Dark}{design[1] * state.full_width()}{RESET}\n",
-        f"{pre}{RESET}{design[0]}{Style.Dark}{design[2] * state.full_width()}{RESET}"
+                    for chunk in self.arrange(self.parse_partial()):
+                        yield chunk
+                    continue
+
+                try:
+                    data = pending.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    pending = None
+
+                TimeoutIx = 0
+                for chunk in self.feed(data):
+                    yield chunk
+
+            for chunk in self.flush():
+                yield chunk
+
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    def width_calc(self):
+        state, Style = self.state, self.Style
+        if state.WidthArg:
+           width = state.WidthArg
+        elif state.resize_seen != Resize.count or (not state.resize_hooked and time.monotonic() - state.resize_time >= ResizePoll):
+           # Either the terminal told us it changed or, if it can't, we're due for a look
+           state.resize_seen = Resize.count
+           state.resize_time = time.monotonic()
+           try:
+               width = shutil.get_terminal_size().columns
+               state.WidthWrap = True
+           except (AttributeError, OSError):
+               # this means it's a pager, we can just ignore the base64 clipboard
+               width = 80
+               pass
+        else:
+           width = state.WidthFull
+
+        # The list item stack and blockquotes change the padding as well so
+        # they're part of what we check against, and so does whether there are colors
+        key = (width, len(state.list_item_stack), state.block_depth, len(state.current_line) == 0, Style.Plaintext)
+        if state.width_key == key:
+            return
+
+        state.width_key = key
+        state.WidthFull = width
+
+        state.Width = state.WidthFull - 2 * Style.Margin
+        pre = state.space_left(listwidth=True) if Style.PrettyBroken else ''
+        Style.Rule = f"{Style.MarginSpaces}{FG}{Style.Symbol}{'─' * state.Width}{RESET}"
+        design  = [FG, '▄','▀'] if Style.PrettyPad else [BG, ' ',' ']
+        Style.Codepad = [
+            f"{pre}{RESET}{design[0]}{Style.Dark}{design[1] * state.full_width()}{RESET}\n",
+            f"{pre}{RESET}{design[0]}{Style.Dark}{design[2] * state.full_width()}{RESET}"
+        ]
+        if Style.Plaintext:
+            Style.Rule, Style.Codepad = strip_codes(Style.Rule), strip_codes(Style.Codepad)
+
+class Remote:
+    # A client's connection to the daemon. Its stdin comes in over the socket, the same
+    # way a pipe does, so it goes through the select() loop for the prompt handling
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+class LogStream:
+    # The log shares the output with the render so it goes through the same batches to stay in order
+    def __init__(self, sd):
+        self.sd = sd
+
+    def write(self, msg):
+        (self.sd.writer or sys.stdout).write(msg)
+
+    def flush(self):
+        (self.sd.writer or sys.stdout).flush()
+
+def banner(fname):
+    # What goes between files when there's more than one
+    return BytesIO(f"\n------\n# {fname}\n\n------\n".encode('utf-8'))
+
+def render_one(sd, fname, with_banner = False, fmt = 'ansi'):
+    # A file from the command line, after the banner if there's more than one
+    if fmt == 'jsonl':
+        sd.render_events(open(fname, "rb"), name = fname if with_banner else None)
+        return
+
+    if with_banner:
+        sd.render(banner(fname))
+
+    inp = open(fname, "rb")
+    # A fifo or a <(...) is a stream like stdin can be, it gets read as it shows up and the
+    # output goes out while we're waiting on it rather than when the next bit comes in
+    sd.state.is_pty = os.name != 'nt' and not stat.S_ISREG(os.fstat(inp.fileno()).st_mode)
+    try:
+        sd.render(inp)
+    finally:
+        sd.state.is_pty = False
+
+def render_path(sd, fname, with_banner, fmt):
+    # Where a file rendered by this instance lives in the --cache. That's down to what's
+    # in it, this version of us and everything in the setup that changes how it looks
+    import hashlib
+    state, Style = sd.state, sd.Style
+    cache_dir = cache_path('render')
+    if not cache_dir:
+        return None
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(ChunkSize), b''):
+            digest.update(chunk)
+
+    keyList = [
+        digest.hexdigest(), os.stat(__file__).st_mtime_ns, fmt, with_banner and fname, state.WidthFull,
+        [getattr(Style, attr) for attr in ['Dark', 'Mid', 'Symbol', 'Head', 'Grey', 'Bright', 'Syntax', 'Margin', 'ListIndent', 'PrettyPad', 'PrettyBroken', 'Plaintext']],
+        [getattr(state, attr) for attr in ['Links', 'Images', 'CodeSpaces']],
+        os.environ.get('TERM', ''), os.environ.get('TERM_PROGRAM', '')
     ]
+    return os.path.join(cache_dir, hashlib.sha1(repr(keyList).encode('utf-8')).hexdigest())
+
+def render_load(path):
+    # A --cache entry is the length in bytes of the last code block, that code block and
+    # then the rendered file. It's all kept as bytes so a \r\n comes back as a \r\n
+    data = cache_read(path)
+    if data is None:
+        return None
+    try:
+        size, rest = data.split(b'\n', 1)
+        size = int(size)
+    except ValueError:
+        return None
+    return rest[size:].decode('utf-8', 'replace'), rest[:size].decode('utf-8', 'replace')
+
+def render_file(fname, options, with_banner = False, scrape_ix = 0, fmt = 'ansi', cache = False):
+    # One file for --jobs, --outdir or --cache, with a Streamdown of its own. It hands back
+    # what it rendered, its last code block for the clipboard and where the scrape count got to
+    out = StringIO()
+    sd = Streamdown(output = out)
+    sd.setup(**options)
+    sd.state.Logging = False
+    sd.state.scrape_ix = scrape_ix
+
+    if cache:
+        path = render_path(sd, fname, with_banner, fmt)
+        hit = render_load(path)
+        if hit:
+            return hit + (scrape_ix,)
+
+    render_one(sd, fname, with_banner, fmt)
+    text, code = out.getvalue(), sd.state.code_buffer_raw.getvalue()
+    if cache:
+        code_bytes = code.encode('utf-8')
+        cache_save(path, b'%d\n' % len(code_bytes) + code_bytes + text.encode('utf-8'), RenderCache)
+    return text, code, sd.state.scrape_ix
+
+def render_worker(level):
+    # Our log goes through the output but what a worker renders only comes out
+    # later so anything it has to say goes to stderr instead
+    logging.basicConfig(stream=sys.stderr, level=level, format=f'%(message)s', force=True)
+
+def outdir_names(fileList):
+    # What each file is called under --outdir. They keep where they were relative to each
+    # other so two with the same name from different directories don't overwrite each other
+    pathList = [os.path.abspath(fname) for fname in fileList]
+    try:
+        top = os.path.commonpath([os.path.dirname(path) for path in pathList])
+    except ValueError:
+        # They're on different drives so those become the top directories
+        return [os.path.join(*filter(None, re.split(r'[\\/:]+', path))) for path in pathList]
+    return [os.path.relpath(path, top) for path in pathList]
+
+def render_files(sd, fileList, options, jobs = 1, outdir = None, fmt = 'ansi', cache = False):
+    # Each file is rendered on its own, in a pool of processes if there's more than one job,
+    # and they go out in the order they were given either to our output or a file each
+    with_banner = len(fileList) > 1 and not outdir
+    pool = None
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers = jobs, initializer = render_worker, initargs = (logging.getLogger().level,))
+        count = len(fileList)
+        resultList = pool.map(render_file, fileList, [options] * count, [with_banner] * count, [0] * count, [fmt] * count, [cache] * count)
 
+    else:
+        def serial():
+            # The scraped code is numbered across all the files so this is the way that has to go
+            scrape_ix = 0
+            for fname in fileList:
+                result = render_file(fname, options, with_banner, scrape_ix, fmt, cache)
+                scrape_ix = result[2]
+                yield result
+        resultList = serial()
+
+    out = sd.output or sys.stdout
+    try:
+        for name, (text, code, _) in zip(outdir_names(fileList), resultList):
+            if outdir:
+                ext = '.jsonl' if fmt == 'jsonl' else '.txt' if options.get('plaintext') else '.ans'
+                path = os.path.join(outdir, name + ext)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write(text)
+            else:
+                out.write(text)
+                out.flush()
+
+            if code:
+                sd.state.code_buffer_raw.clear()
+                sd.state.code_buffer_raw.write(code)
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures = True)
+
+def daemon_path():
+    return os.path.join(gettmpdir(), 'daemon.sock')
+
+def daemon_session(sock):
+    import json
+    # The first line is what the client was started with, everything after it is input.
+    # We take it a byte at a time so none of the input ends up read ahead
+    header = bytearray()
+    while not header.endswith(b'\n'):
+        byte = sock.recv(1)
+        if not byte:
+            return
+        header += byte
+    opts = json.loads(header)
+
+    out = sock.makefile('w', encoding='utf-8', errors='replace')
+    # Things like the clipboard depend on whether the client is on a terminal
+    out.isatty = lambda: opts.get('tty', False)
+
+    sd = Streamdown(output = out)
+    H, S, V = opts.get('base') or [None, None, None]
+    sd.setup(config_path=opts.get('config'), H=H, S=S, V=V, plaintext=opts.get('strip') or opts.get('format') == 'jsonl', scrape=opts.get('scrape'), width=opts.get('width'), prompt=opts.get('prompt'))
+    if not sd.state.WidthArg:
+        # We can't see their terminal so we go with what they told us it was
+        sd.state.WidthArg = opts.get('columns') or 80
+        sd.state.WidthWrap = True
+        sd.state.width_key = None
+        sd.width_calc()
 
-_sd = Streamdown()
-Style = _sd.Style
-state = _sd.state
+    try:
+        fileList = opts.get('files') or []
+        if fileList:
+            sd.state.Logging = False
+            for fname in fileList:
+                render_one(sd, fname, len(fileList) > 1, opts.get('format', 'ansi'))
+        else:
+            # Either way it's the socket, which gets read through select() like a pipe
+            sd.state.is_pty = True
+            if opts.get('format') == 'jsonl':
+                sd.render_events(Remote(sock))
+            else:
+                sd.render(Remote(sock))
+
+        sd.tidyup()
+        out.flush()
+    except (OSError, ValueError):
+        # they went away
+        pass
+    except Exception as ex:
+        logging.warning(f"Exception thrown: {type(ex)} {ex}")
+        traceback.print_exc()
+    finally:
+        # out has the socket open too, it only goes when both are closed
+        try:
+            out.close()
+        except OSError:
+            pass
+        sock.close()
+
+def daemon():
+    # Renders for any number of clients at once, each gets its own Streamdown. The
+    # imports, lexers and formatters only get loaded once and then stay warm. The config
+    # is small and read again for each client so changing it doesn't need a restart
+    import socket, threading
+    path = daemon_path()
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            logging.warning(f"There's already a daemon on {path}")
+            return 1
+        except OSError:
+            # that one's gone
+            os.unlink(path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only we get to connect
+    prev_mask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(prev_mask)
+    server.listen()
+    logging.info(f"Listening on {path}")
+    # so a plain kill still cleans up after us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target = daemon_session, args = (conn,), daemon = True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(path)
+    return 0
+
+def client(args, base):
+    # Hands the work to a running daemon and copies what comes back to stdout.
+    # Returns None if there isn't one so we can just do it ourselves, otherwise
+    # whether it worked
+    import json, socket
+    path = daemon_path()
+    try:
+        # The directory is open to everyone so we make sure it's ours
+        if os.stat(path).st_uid != os.getuid():
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    except OSError:
+        return None
+
+    config = args.config
+    if config and os.path.exists(config):
+        config = open(config).read()
+
+    opts = {
+        'width': int(args.width or 0),
+        'columns': shutil.get_terminal_size().columns,
+        'tty': sys.stdout.isatty(),
+        'config': config,
+        'base': base,
+        'prompt': args.prompt,
+        'strip': args.strip,
+        'format': args.format,
+        'scrape': os.path.abspath(args.scrape) if args.scrape else None,
+        'files': [os.path.abspath(f) for f in args.filenameList],
+    }
+
+    try:
+        sock.sendall(json.dumps(opts).encode('utf-8') + b'\n')
+
+        fdList = [sock.fileno()]
+        if args.filenameList:
+            sock.shutdown(socket.SHUT_WR)
+        else:
+            fdList.append(sys.stdin.fileno())
+
+        while True:
+            ready_in, _, _ = select.select(fdList, [], [])
+            if sys.stdin.fileno() in ready_in:
+                data = os.read(sys.stdin.fileno(), ChunkSize)
+                if data:
+                    sock.sendall(data)
+                else:
+                    sock.shutdown(socket.SHUT_WR)
+                    fdList.remove(sys.stdin.fileno())
+
+            if sock.fileno() in ready_in:
+                data = sock.recv(ChunkSize)
+                if not data:
+                    break
+                try:
+                    os.write(sys.stdout.fileno(), data)
+                except BrokenPipeError:
+                    # whatever we're piped into has had enough
+                    break
+    except KeyboardInterrupt:
+        pass
+    except OSError as ex:
+        # The daemon went away partway through, what it was sent is gone with it
+        logging.error(f"Lost the daemon on {path}: {ex}")
+        return False
+    finally:
+        sock.close()
+    return True
 
 def main():
-    global _sd, Style, state
     parser = ArgumentParser(
             formatter_class=argparse.RawDescriptionHelpFormatter, description=textwrap.dedent(f"""
     Streamdown is a streaming markdown renderer for modern terminals.
@@ -1246,8 +2560,16 @@ def main():
     parser.add_argument("-e", "--exec", help="Wrap a program EXEC for more 'proper' i/o handling")
     parser.add_argument("-p", "--prompt", default="^.*>\\s+$", help="A PCRE regex prompt to detect (default: %(default)s)")
     parser.add_argument("-s", "--scrape", help="Scrape code snippets to a directory SCRAPE")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Render this many files at once, they still come out in order")
+    parser.add_argument("-o", "--outdir", help="Render each file to its own file in OUTDIR instead of stdout")
     parser.add_argument("-v", "--version", action="store_true", help="Show version information")
     parser.add_argument("--strip", action="store_true", help="Just strip the markdown and output plaintext")
+    parser.add_argument("--format", choices=["ansi", "jsonl"], default="ansi", help="Output rendered text or one JSON event per block (default: %(default)s)")
+    parser.add_argument("--cache", action="store_true", help="Reuse what files rendered to last time if nothing's changed")
+    parser.add_argument("--daemon", action="store_true", help="Stay running and render for --client invocations")
+    parser.add_argument("--client", action="store_true", help="Render through a running --daemon, or here if there isn't one")
+    parser.add_argument("--profile", action="store_const", const="table", help="Print where the time went to stderr at exit")
+    parser.add_argument("--profile-json", dest="profile", action="store_const", const="json", help="The same as --profile but as JSON")
     args = parser.parse_args()
 
 
@@ -1256,6 +2578,7 @@ def main():
             import importlib.metadata
             print(importlib.metadata.version("streamdown"))
         except importlib.metadata.PackageNotFoundError:
+            import subprocess
             print(subprocess.run(
                 ['git', 'describe', '--always', '--dirty', '--tags'],
                 cwd=os.path.dirname(os.path.abspath(__file__)),
@@ -1275,9 +2598,24 @@ def main():
         if len(env_colors) > 1: S = float(env_colors[1])
         if len(env_colors) > 2: V = float(env_colors[2])
 
-    _sd.setup(config_path=args.config, H=H, S=S, V=V, scrape=args.scrape, width=args.width, prompt=args.prompt)
+    if args.daemon and os.name != 'nt':
+        logging.basicConfig(level=args.loglevel.upper(), format=f'%(message)s')
+        sys.exit(daemon())
+
+    # There's nothing to send a terminal program or a keyboard over so those stay here
+    if args.client and os.name != 'nt' and not args.exec and not args.profile and not args.cache and (args.filenameList or not sys.stdin.isatty()):
+        res = client(args, [H, S, V])
+        if res is not None:
+            sys.exit(0 if res else 1)
 
-    logging.basicConfig(stream=sys.stdout, level=args.loglevel.upper(), format=f'%(message)s')
+    sd = Streamdown()
+    state = sd.state
+    # There's no escape codes in json so the last reset shouldn't be one either
+    plaintext = args.strip or args.format == 'jsonl'
+    sd.setup(config_path=args.config, H=H, S=S, V=V, plaintext=plaintext, scrape=args.scrape, width=args.width, prompt=args.prompt)
+    profile = args.profile and sd.profile()
+
+    logging.basicConfig(stream=LogStream(sd), level=args.loglevel.upper(), format=f'%(message)s')
     if os.name != 'nt':
         state.exec_master, state.exec_slave = pty.openpty()
     try:
@@ -1285,20 +2623,32 @@ def main():
         if args.exec and os.name != 'nt':
             state.terminal = termios.tcgetattr(sys.stdin)
             state.is_exec = True
+            import subprocess
             state.exec_sub = subprocess.Popen(args.exec.split(' '), stdin=state.exec_slave, stdout=state.exec_slave, stderr=state.exec_slave, close_fds=True)
             os.close(state.exec_slave)  # We don't need slave in parent
             # Set stdin to raw mode so we don't need to press enter
             tty.setcbreak(sys.stdin.fileno())
             sys.stdout.write("\x1b[?7h")
-            emit(inp)
+            sd.emit(inp)
+
+        elif args.filenameList and ((args.jobs > 1 and not profile) or args.outdir or args.cache):
+            if args.outdir:
+                os.makedirs(args.outdir, exist_ok=True)
+            options = {
+                'config_path': args.config, 'H': H, 'S': S, 'V': V, 'plaintext': plaintext,
+                'scrape': args.scrape, 'width': args.width, 'prompt': args.prompt
+            }
+            # Scraped code is numbered across all the files so that can only go one at a time
+            jobs = 1 if args.scrape else args.jobs
+            # and it's the rendering that writes the snippets out, so that can't be skipped
+            cache = args.cache and not args.scrape
+            render_files(sd, args.filenameList, options, jobs, args.outdir, args.format, cache)
 
         elif args.filenameList:
             # Let's say we only care about logging in streams
             state.Logging = False
             for fname in args.filenameList:
-                if len(args.filenameList) > 1:
-                    _sd.render(BytesIO(f"\n------\n# {fname}\n\n------\n".encode('utf-8')))
-                _sd.render(open(fname, "rb"))
+                render_one(sd, fname, len(args.filenameList) > 1, args.format)
                 
         elif sys.stdin.isatty():
             parser.print_help()
@@ -1307,7 +2657,10 @@ def main():
             # this is a more sophisticated thing that we'll do in the main loop
             state.is_pty = True
             os.set_blocking(inp.fileno(), False) 
-            _sd.render(inp)
+            if args.format == 'jsonl':
+                sd.render_events(inp)
+            else:
+                sd.render(inp)
 
     except (OSError, KeyboardInterrupt):
         state.exit = 130
@@ -1319,7 +2672,10 @@ def main():
         traceback.print_exc()
         state.exit = 1
 
-    _sd.tidyup()
+    sd.tidyup()
+    if profile:
+        profile.stop()
+        profile.print(args.profile)
     sys.exit(state.exit)
 
 if __name__ == "__main__": 
@@ -0,0 +1,107 @@
+# Keeps track of what the escape codes seen so far add up to: the colors, bold and
+# friends (SGR) and which OSC 8 link we're in. That's so it can all be put back at the
+# start of a wrapped line with a single code instead of replaying every one of them.
+#
+# Each distinct code is only ever parsed once. What it does is remembered as an
+# Effect which is then just applied to the state.
+
+# The on/off attributes as bits
+Bold, Dim, Italic, Underline, Blink, Reverse, Hidden, Strike = (1 << ix for ix in range(8))
+OnMap = {1: Bold, 2: Dim, 3: Italic, 4: Underline, 5: Blink, 7: Reverse, 8: Hidden, 9: Strike}
+OffMap = {22: Bold | Dim, 23: Italic, 24: Underline, 25: Blink, 27: Reverse, 28: Hidden, 29: Strike}
+# The order they get put back in
+FlagList = [(bit, str(code)) for code, bit in OnMap.items()]
+
+class Effect:
+    # What one code does. The colors are None when they're left alone, '' when
+    # they go back to the default and otherwise the parameters that set them.
+    # link is the same only for an OSC 8
+    __slots__ = ('reset', 'on', 'off', 'fg', 'bg', 'ul', 'link')
+    def __init__(self):
+        self.reset = False
+        self.on = self.off = 0
+        self.fg = self.bg = self.ul = self.link = None
+
+EffectMap = {}
+
+def parse(code):
+    effect = Effect()
+    if code.startswith('\033]8;'):
+        # \033]8;params;url\033\ and an empty url closes it
+        effect.link = code[4:].split(';', 1)[-1].rstrip('\\').rstrip('\033')
+        return effect
+
+    if not (code.startswith('\033[') and code.endswith('m')):
+        # Not something that changes how text looks
+        return effect
+
+    paramList = code[2:-1].split(';')
+    ix = 0
+    while ix < len(paramList):
+        param = paramList[ix]
+        n = int(param) if param.isdigit() else 0
+        ix += 1
+        if n == 0:
+            effect.reset = True
+            effect.on = effect.off = 0
+            effect.fg = effect.bg = effect.ul = ''
+        elif n in OnMap:
+            effect.on |= OnMap[n]
+            effect.off &= ~OnMap[n]
+        elif n in OffMap:
+            effect.off |= OffMap[n]
+            effect.on &= ~OffMap[n]
+        elif n in (38, 48, 58):
+            # 5;n or 2;r;g;b come after
+            take = 2 if paramList[ix : ix + 1] == ['5'] else 4
+            value = ';'.join([param] + paramList[ix : ix + take])
+            ix += take
+            if n == 38:
+                effect.fg = value
+            elif n == 48:
+                effect.bg = value
+            else:
+                effect.ul = value
+        elif n == 39:
+            effect.fg = ''
+        elif n == 49:
+            effect.bg = ''
+        elif n == 59:
+            effect.ul = ''
+        elif 30 <= n <= 37 or 90 <= n <= 97:
+            effect.fg = param
+        elif 40 <= n <= 47 or 100 <= n <= 107:
+            effect.bg = param
+    return effect
+
+class Sgr:
+    __slots__ = ('flags', 'fg', 'bg', 'ul', 'link')
+    def __init__(self):
+        self.flags = 0
+        self.fg = self.bg = self.ul = self.link = ''
+
+    def feed(self, code):
+        effect = EffectMap.get(code)
+        if effect is None:
+            effect = EffectMap[code] = parse(code)
+
+        if effect.reset:
+            self.flags = 0
+        self.flags = (self.flags & ~effect.off) | effect.on
+        if effect.fg is not None:
+            self.fg = effect.fg
+        if effect.bg is not None:
+            self.bg = effect.bg
+        if effect.ul is not None:
+            self.ul = effect.ul
+        if effect.link is not None:
+            self.link = effect.link
+
+    def reopen(self):
+        # The one code (and maybe a link) that gets a fresh line back to here
+        paramList = [code for bit, code in FlagList if self.flags & bit]
+        paramList += [value for value in (self.fg, self.bg, self.ul) if value]
+        res = f"\033[{';'.join(paramList)}m" if paramList else ''
+        if self.link:
+            res += f"\033]8;;{self.link}\033\\"
+        return res
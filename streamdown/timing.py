@@ -0,0 +1,244 @@
+# Where the time goes. A Profile hooks into a Streamdown instance, and the module level
+# helpers it calls, by wrapping them. Nothing is wrapped until one is asked for so
+# when it's off there's nothing to pay.
+#
+#   sd --profile file.md         a table on stderr at exit
+#   sd --profile-json file.md    the same as JSON, to hold up against another run
+#
+# or from code:
+#
+#   profile = sd.profile()
+#   sd.render(...)
+#   profile.report()
+#
+# Stage times are exclusive: text_wrap doesn't count the line_format it called. The
+# time for each kind of line is everything it took to lay it out. "read" includes
+# waiting on the input, so for a stream that's mostly how slow the other end is.
+#
+# The module level helpers (visible_length, highlight_tokens, re and the patterns compiled
+# ahead of time ...) are shared, so while one instance is being profiled every instance's
+# calls to those get counted.
+import json, re, sys, time
+
+clock = time.perf_counter
+
+class CountedRe:
+    # Stands in for the re module, or one of the patterns compiled with it, and counts
+    # the calls that go through it
+    def __init__(self, re, counterMap):
+        self.re = re
+        self.counterMap = counterMap
+
+    def __getattr__(self, name):
+        attr = getattr(self.re, name)
+        if name not in ('match', 'fullmatch', 'search', 'sub', 'subn', 'split', 'findall', 'finditer'):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.counterMap['regex_calls'] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+class CountedFile:
+    # The output, counting what's written to it and how many times it's written and flushed
+    def __init__(self, profile, file):
+        self.file = file
+        self.write = profile.timed('write', self.count_write)
+        self.flush = profile.timed('write', self.count_flush)
+        self.counterMap = profile.counterMap
+
+    def count_write(self, text):
+        self.counterMap['writes'] += 1
+        self.counterMap['bytes_out'] += len(text)
+        return self.file.write(text)
+
+    def count_flush(self):
+        # On a terminal each of these is what actually makes it out
+        self.counterMap['flushes'] += 1
+        return self.file.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class Profile:
+    # The stages each get [calls, seconds] and the kinds of line [lines, seconds]
+    MethodList = ['line_format', 'text_wrap', 'emit_h', 'code_wrap', 'lex_line']
+    GeneratorList = ['read_lines', 'arrange', 'format_table']
+    HelperList = ['highlight_tokens', 'classify']
+
+    def __init__(self, sd, module):
+        self.sd = sd
+        self.module = module
+        self.stageMap = {}
+        self.kindMap = {}
+        self.counterMap = {'measured_chars': 0, 'regex_calls': 0, 'writes': 0, 'flushes': 0, 'bytes_out': 0}
+        # How much of the time of each timed call we're inside of went to its callees
+        self.stack = []
+        self.start = clock()
+        self.undoList = []
+        # Telling the kinds of line apart shouldn't show up as time spent classifying
+        self.classify = module['classify']
+
+        for name in self.MethodList:
+            self.hook(sd.__dict__, name, self.timed(name, getattr(sd, name)))
+        for name in self.GeneratorList:
+            self.hook(sd.__dict__, name, self.timed_gen(name, getattr(sd, name)))
+        self.hook(sd.__dict__, 'parse_line', self.timed_line(sd.parse_line))
+
+        for name in self.HelperList:
+            self.hook(module, name, self.timed(name, module[name]))
+
+        measure = module['visible_length']
+        def visible_length(text):
+            self.counterMap['measured_chars'] += len(text)
+            return measure(text)
+        self.hook(module, 'visible_length', visible_length)
+        self.hook(module, 're', CountedRe(module['re'], self.counterMap))
+        self.hook_patterns(module)
+        # The width helpers have patterns of their own
+        self.hook_patterns(sys.modules[module['display_width'].__module__].__dict__)
+
+        self.output = sd.output
+        sd.output = CountedFile(self, sd.output or sys.stdout)
+
+    def hook(self, where, name, fn):
+        self.undoList.append((where, name, where.get(name)))
+        where[name] = fn
+
+    def hook_patterns(self, where):
+        # Every pattern compiled at the module level, and the ones the line classifier
+        # keeps in its LeadMap, gets counted like a call through re
+        countedMap = {}
+        for name, value in list(where.items()):
+            if isinstance(value, re.Pattern):
+                countedMap[id(value)] = CountedRe(value, self.counterMap)
+                self.hook(where, name, countedMap[id(value)])
+        if 'LeadMap' in where:
+            self.hook(where, 'LeadMap', {lead: [(kind, countedMap.get(id(regex), regex)) for kind, regex in pairList]
+                for lead, pairList in where['LeadMap'].items()})
+
+    def stop(self):
+        """Unhooks everything. The numbers so far stay around for report()"""
+        for where, name, old in reversed(self.undoList):
+            if where is self.sd.__dict__:
+                # it was the class's method
+                where.pop(name, None)
+            else:
+                where[name] = old
+        self.undoList = []
+        self.sd.output = self.output
+
+    def timed(self, name, fn):
+        stage = self.stageMap.setdefault(name, [0, 0.0])
+        stack = self.stack
+        def wrapper(*args, **kwargs):
+            stack.append(0.0)
+            start = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                stage[0] += 1
+                stage[1] += elapsed - stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+        return wrapper
+
+    def step(self, stage, gen):
+        # One trip into a generator, timed like a call. Hands back (done, item, elapsed)
+        stack = self.stack
+        stack.append(0.0)
+        start = clock()
+        try:
+            return False, next(gen), clock() - start
+        except StopIteration:
+            return True, None, clock() - start
+        finally:
+            elapsed = clock() - start
+            stage[0] += 1
+            stage[1] += elapsed - stack.pop()
+            if stack:
+                stack[-1] += elapsed
+
+    def timed_gen(self, name, fn):
+        stage = self.stageMap.setdefault(name, [0, 0.0])
+        def wrapper(*args):
+            gen = fn(*args)
+            while True:
+                done, item, _ = self.step(stage, gen)
+                if done:
+                    return
+                yield item
+        return wrapper
+
+    def timed_line(self, fn):
+        stage = self.stageMap.setdefault('parse_line', [0, 0.0])
+        def wrapper(line):
+            kind = self.kind(line)
+            total = 0
+            gen = fn(line)
+            while True:
+                done, item, elapsed = self.step(stage, gen)
+                total += elapsed
+                if done:
+                    break
+                yield item
+
+            if self.sd.state.in_code:
+                # the fence that closes it is already out of code by now
+                kind = 'code'
+            entry = self.kindMap.setdefault(kind, [0, 0.0])
+            entry[0] += 1
+            entry[1] += total
+        return wrapper
+
+    def kind(self, line):
+        state, Line = self.sd.state, self.module['Line']
+        if state.in_code:
+            return 'code'
+        if not line.endswith('\n'):
+            return 'partial'
+        if not line.strip():
+            return 'blank'
+
+        # This is the line before any of the layout, it's close enough to tell them apart.
+        # The patterns it tries aren't the renderer's so they don't count
+        calls = self.counterMap['regex_calls']
+        kind = self.classify(line)
+        self.counterMap['regex_calls'] = calls
+        return {
+            Line.Block: 'quote', Line.Fence: 'code', Line.Table: 'table', Line.Item: 'list',
+            Line.Header: 'header', Line.Rule: 'rule'
+        }.get(kind.kind, 'list' if state.in_list else 'prose')
+
+    def report(self):
+        """The numbers so far as a dict"""
+        ms = lambda s: round(s * 1000, 3)
+        return {
+            'wall_ms': ms(clock() - self.start),
+            'stages': {name: {'calls': calls, 'ms': ms(spent)}
+                for name, (calls, spent) in sorted(self.stageMap.items(), key = lambda kv: -kv[1][1]) if calls},
+            'lines': {kind: {'lines': lines, 'ms': ms(spent)}
+                for kind, (lines, spent) in sorted(self.kindMap.items(), key = lambda kv: -kv[1][1])},
+            'counters': dict(self.counterMap),
+        }
+
+    def table(self):
+        """The numbers so far laid out for a person"""
+        report = self.report()
+        rowList = [f"{'stage':<16}{'calls':>10}{'ms':>12}"]
+        rowList += [f"{name:<16}{v['calls']:>10}{v['ms']:>12.3f}" for name, v in report['stages'].items()]
+        rowList += ['', f"{'line kind':<16}{'lines':>10}{'ms':>12}"]
+        rowList += [f"{kind:<16}{v['lines']:>10}{v['ms']:>12.3f}" for kind, v in report['lines'].items()]
+        rowList += ['']
+        rowList += [f"{name:<16}{value:>22}" for name, value in report['counters'].items()]
+        rowList += [f"{'wall ms':<16}{report['wall_ms']:>22.3f}"]
+        return '\n'.join(rowList)
+
+    def print(self, fmt = 'table', file = None):
+        file = file or sys.stderr
+        if fmt == 'json':
+            json.dump(self.report(), file, indent = 2)
+            print(file = file)
+        else:
+            print(self.table(), file = file)
@@ -0,0 +1,95 @@
+# How many terminal columns a string takes up. This gives the same answer as adding
+# up wcwidth() over the string with the escape codes stripped out, just quicker:
+#
+#  * plain printable ascii is its length
+#  * everything else in the BMP goes through a table that remembers what wcwidth
+#    said the first time it saw the character
+#  * a whole string of those is measured by str.translate rather than a character
+#    at a time (see WidthMap)
+#  * escape codes are split around while measuring instead of making a stripped copy
+import re
+from wcwidth import wcwidth
+
+ANSIESCAPE = r'\033(?:\[[0-9;?]*[a-zA-Z]|][0-9]*;;.*?\\|\\)'
+AnsiRe = re.compile(ANSIESCAPE)
+
+# wcwidth + 2 (it says -1 for control characters) and 0 for the ones we haven't looked up.
+# It's filled in as we go so there's nothing to pay for at import time
+Table = bytearray(0x10000)
+
+def char_width(c):
+    o = ord(c)
+    if o > 0xffff:
+        return wcwidth(c)
+
+    if not Table[o]:
+        Table[o] = wcwidth(c) + 2
+    return Table[o] - 2
+
+class WidthMap(dict):
+    # For str.translate. Each character turns into as many as it is wide so the length
+    # of what comes out is the width. The control characters wcwidth says -1 for turn
+    # into a NUL each, which is counted back off (a NUL of its own is 0 wide, it's gone)
+    def __missing__(self, o):
+        width = char_width(chr(o))
+        self[o] = res = '\0' if width < 0 else 'x' * width
+        return res
+
+Widths = WidthMap()
+
+def span_width(text):
+    # text without any escape codes in it
+    if text.isascii() and text.isprintable():
+        return len(text)
+    wide = text.translate(Widths)
+    return len(wide) - 2 * wide.count('\0')
+
+def display_width(text):
+    # The escape character isn't printable so this also means there's no codes
+    if text.isascii() and text.isprintable():
+        return len(text)
+
+    if '\033' not in text:
+        return span_width(text)
+
+    # The pieces between the codes, measured where they are
+    return sum(map(span_width, AnsiRe.split(text)))
+
+def truncate(text, width, tail = '…'):
+    # Chops characters off the end of text, escape codes and all, until it plus the tail
+    # is narrower than width. That used to be done a character at a time, measuring
+    # the whole thing again each time, so this gives exactly what that gave (it starts
+    # by taking two off). An escape code that's been cut into isn't an escape code
+    # anymore and its pieces count like any other character.
+    size = display_width(text)
+    if size < width:
+        return text
+
+    widthList = [char_width(c) for c in text]
+    codeList = [(m.start(), m.end()) for m in AnsiRe.finditer(text)]
+    # which escape code, if any, each character is in
+    ownerList = [-1] * len(text)
+    for ix, (start, end) in enumerate(codeList):
+        ownerList[start:end] = [ix] * (end - start)
+
+    tailsize = display_width(tail)
+    cut = len(text)
+    while True:
+        if cut < len(text) - 1 and size + tailsize < width:
+            return text[:cut] + tail
+
+        if cut == 0:
+            # there's no room for anything
+            return tail
+
+        cut -= 1
+        owner = ownerList[cut]
+        if owner == -1:
+            size -= widthList[cut]
+        else:
+            start, end = codeList[owner]
+            if cut + 1 == end:
+                # the code is now broken so what's left of it shows
+                size += sum(widthList[start:cut])
+            else:
+                size -= widthList[cut]
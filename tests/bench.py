@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Throughput benchmark. Renders the markdown files in here plus some generated stress
+# inputs through Streamdown.render at fixed widths with the output going to a buffer
+# and prints what it found as JSON, so you can save it and hold it up against another
+# commit:
+#
+#   ./bench.py > before.json
+#   ...
+#   ./bench.py --compare before.json
+#
+# Wall time is the best of --repeat runs. Peak memory comes from a separate run
+# under tracemalloc since that slows everything down. The generated inputs are
+# 10k lines of code, a 500 row table, a megabyte long paragraph and deeply nested
+# lists, --scale makes them bigger or smaller.
+import argparse, io, json, os, platform, subprocess, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from streamdown.sd import Streamdown
+
+# Nothing gets written outside of the run
+Config = """
+[features]
+Savebrace = false
+Logging = false
+Clipboard = false
+"""
+
+def synthetic(scale = 1):
+    size = lambda n: max(1, int(n * scale))
+    code = "```python\n" + "".join(
+        f"def fn_{i}(x, y = {i}):\n    return [x * y for _ in range({i % 10})]  # line {i}\n" for i in range(size(5000))
+    ) + "```\n"
+
+    table = "| id | name | description | amount |\n|---|---|---|---:|\n" + "".join(
+        f"| {i} | item **{i}** | some `text` that goes on for a bit in row {i} | {i * 3.5} |\n" for i in range(size(500))
+    )
+
+    words = ["stream", "*render*", "the", "markdown", "`inline`", "terminal", "**wide**", "字符", "text", "a"]
+    paragraph = " ".join(words[i % len(words)] for i in range(size(120000))) + "\n"
+
+    nested = "".join(
+        "  " * depth + ("- " if depth % 2 else "1. ") + f"item at depth {depth} with *some* text in it\n"
+        for _ in range(size(50)) for depth in range(24)
+    )
+
+    return {
+        'synthetic/code-10k-lines': code,
+        'synthetic/table-500-rows': table,
+        'synthetic/paragraph-1mb': paragraph,
+        'synthetic/nested-lists': nested,
+    }
+
+def corpus(fileList):
+    here = os.path.dirname(os.path.abspath(__file__))
+    fileList = fileList or sorted(f for f in os.listdir(here) if f.endswith('.md'))
+    return {name: open(os.path.join(here, name), 'rb').read().decode('utf-8', 'replace') for name in fileList}
+
+def render(data, width):
+    out = io.StringIO()
+    sd = Streamdown(output = out)
+    sd.setup(config_path = Config, width = width)
+    sd.render(io.BytesIO(data))
+    return out.getvalue()
+
+def measure(name, text, width, repeat):
+    data = text.encode('utf-8')
+    wallList = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = render(data, width)
+        wallList.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    render(data, width)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    wall = min(wallList)
+    lines = text.count('\n')
+    return {
+        'name': name,
+        'width': width,
+        'bytes': len(data),
+        'lines': lines,
+        'output_bytes': len(output.encode('utf-8')),
+        'wall_s': round(wall, 6),
+        'bytes_per_s': round(len(data) / wall, 1),
+        'lines_per_s': round(lines / wall, 1),
+        'peak_memory_bytes': peak,
+    }
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True,
+                cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(old, new):
+    # wall time ratio for everything that's in both, under 1 is faster
+    before = {(r['name'], r['width']): r for r in old['results']}
+    for r in new['results']:
+        prev = before.get((r['name'], r['width']))
+        if prev:
+            ratio = r['wall_s'] / prev['wall_s'] if prev['wall_s'] else 0
+            print(f"{ratio:6.2f}x  {prev['wall_s']:9.4f}s -> {r['wall_s']:9.4f}s  {r['name']} @ {r['width']}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Streamdown throughput benchmark")
+    parser.add_argument('fileList', nargs = '*', help = "Markdown files in tests/ to run (default: all of them)")
+    parser.add_argument('-w', '--width', type = int, action = 'append', help = "Width to render at, can be given more than once (default: 80 and 45)")
+    parser.add_argument('-r', '--repeat', type = int, default = 3, help = "Runs per input, the best one is reported")
+    parser.add_argument('--no-synthetic', action = 'store_true', help = "Skip the generated stress inputs")
+    parser.add_argument('--only-synthetic', action = 'store_true', help = "Only run the generated stress inputs")
+    parser.add_argument('-s', '--scale', type = float, default = 1, help = "Size multiplier for the generated inputs")
+    parser.add_argument('-o', '--output', help = "Write the JSON here instead of stdout")
+    parser.add_argument('--compare', help = "A previous JSON result to print a wall time comparison against (to stderr)")
+    args = parser.parse_args()
+
+    inputs = {} if args.only_synthetic else corpus(args.fileList)
+    if not args.no_synthetic:
+        inputs |= synthetic(args.scale)
+
+    results = []
+    for width in args.width or [80, 45]:
+        for name, text in inputs.items():
+            results.append(measure(name, text, width, args.repeat))
+            print(f"{results[-1]['wall_s']:9.4f}s  {name} @ {width}", file=sys.stderr)
+
+    total_bytes = sum(r['bytes'] for r in results)
+    total_wall = sum(r['wall_s'] for r in results)
+    report = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'repeat': args.repeat,
+        'scale': args.scale,
+        'results': results,
+        'total': {
+            'bytes': total_bytes,
+            'lines': sum(r['lines'] for r in results),
+            'wall_s': round(total_wall, 6),
+            'bytes_per_s': round(total_bytes / total_wall, 1) if total_wall else 0,
+        }
+    }
+
+    if args.compare:
+        compare(json.load(open(args.compare)), report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# Renders the markdown files in here, and a copy of each with \r\n line endings, three
+# times: without --cache, with it on an empty cache and with it again once it's filled
+# in. All three have to come out byte for byte the same. Warnings about the markdown
+# aren't part of what's rendered and don't come back from the cache so they're left out.
+#
+#   ./cache.py [file.md ...]
+#
+# The cache goes in a directory of its own so the one you use day to day is left alone.
+import os, subprocess, sys, tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sd = os.path.join(here, '..', 'streamdown', 'sd.py')
+fileList = sys.argv[1:] or sorted(os.path.join(here, f) for f in os.listdir(here) if f.endswith('.md'))
+
+with tempfile.TemporaryDirectory() as tmp:
+    crlfList = []
+    for path in fileList:
+        crlf = os.path.join(tmp, 'crlf-' + os.path.basename(path))
+        with open(path, 'rb') as f, open(crlf, 'wb') as out:
+            out.write(f.read().replace(b'\r\n', b'\n').replace(b'\n', b'\r\n'))
+        crlfList.append(crlf)
+
+    env = dict(os.environ, TMPDIR = tmp)
+    def render(path, *optList):
+        return subprocess.run([sys.executable, sd, '-w', '80', '-l', 'error', *optList, path], env = env,
+                stdout = subprocess.PIPE, stderr = subprocess.DEVNULL).stdout
+
+    failed = 0
+    for path in fileList + crlfList:
+        miss, plain, hit = render(path, '--cache'), render(path), render(path, '--cache')
+        ok = miss == plain == hit
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {os.path.basename(path)}")
+
+    cache_dir = os.path.join(tmp, 'sd', str(os.getuid()), 'render')
+    if not (os.path.isdir(cache_dir) and os.listdir(cache_dir)):
+        print("FAIL nothing was cached")
+        failed += 1
+
+sys.exit(1 if failed else 0)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Starts a daemon and renders the markdown files in here through --client, both
+# piped in and named on the command line and as ansi and as jsonl, and checks it
+# comes out byte for byte the same as rendering them without it.
+#
+#   ./daemon.py [file.md ...]
+#
+# The daemon's socket goes in a directory of its own so one you have running is left alone.
+import os, subprocess, sys, tempfile, time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sd = os.path.join(here, '..', 'streamdown', 'sd.py')
+fileList = sys.argv[1:] or sorted(os.path.join(here, f) for f in os.listdir(here) if f.endswith('.md'))
+
+with tempfile.TemporaryDirectory() as tmp:
+    env = dict(os.environ, TMPDIR = tmp)
+    def render(path, *optList, piped = False):
+        # The exit code too, and a client that never finishes is a failure rather than a hang
+        try:
+            res = subprocess.run([sys.executable, sd, '-w', '80', '-l', 'error', *optList] + ([] if piped else [path]),
+                    env = env, stdin = open(path, 'rb') if piped else subprocess.DEVNULL,
+                    stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, timeout = 60)
+        except subprocess.TimeoutExpired:
+            return None
+        return res.returncode, res.stdout
+
+    daemon = subprocess.Popen([sys.executable, sd, '--daemon', '-l', 'error'], env = env)
+    sock = os.path.join(tmp, 'sd', str(os.getuid()), 'daemon.sock')
+    for _ in range(100):
+        if os.path.exists(sock):
+            break
+        time.sleep(0.1)
+    else:
+        print("FAIL the daemon didn't start")
+        daemon.kill()
+        sys.exit(1)
+
+    failed = 0
+    try:
+        for path in fileList:
+            for fmt in ['ansi', 'jsonl']:
+                for piped in [False, True]:
+                    local = render(path, '--format', fmt, piped = piped)
+                    remote = render(path, '--format', fmt, '--client', piped = piped)
+                    ok = local == remote and daemon.poll() is None
+                    failed += not ok
+                    print(f"{'ok  ' if ok else 'FAIL'} {os.path.basename(path)} {fmt} {'piped' if piped else 'named'}")
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+sys.exit(1 if failed else 0)
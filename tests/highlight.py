@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Code blocks are lexed a line at a time, carrying on from where the line before
+# left off. This lexes every fenced block in the markdown files here both that way
+# and the way it used to be done, the whole block so far for every new line, and
+# makes sure each line comes out in the same colors.
+#
+#   ./highlight.py [-v] [file.md ...]
+#
+# Some lines are different on purpose, those are in KnownMap.
+import argparse, os, re, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from streamdown.sd import Streamdown, get_lexer, clip_tokens
+
+FenceRe = re.compile(r'^\s*(```+)\s*([\w+#-]*)')
+
+# A token that a single regex takes over more than the line before it only matches once
+# its last line is there. Lexing everything again gave just that last line the color of
+# the whole token, the lines above it had already gone out by then. Now it stays the
+# way it was lexed so far, like the lines above it.
+KnownMap = {
+    ('python', '"""'): "a docstring's closing quotes",
+    ('bash', 'EOL'): "the end of a heredoc",
+    ('html', '</script>'): "the end of a <script> longer than a line",
+}
+
+def blocks(path):
+    # (language, lines) for each fenced block
+    language, lineList = None, []
+    for line in open(path, encoding = 'utf-8', errors = 'replace'):
+        line = line.replace('\t', '  ')
+        m = FenceRe.match(line)
+        if language is None and m:
+            language, lineList = m.group(2) or 'Bash', []
+        elif language is not None and m and not m.group(2):
+            yield language, lineList
+            language = None
+        elif language is not None:
+            lineList.append(line)
+
+def colors(tokenList):
+    # the token type of every character
+    res = []
+    for ttype, value in tokenList:
+        res += [ttype] * len(value)
+    return res
+
+def compare(language, lineList):
+    # The lines that come out differently as (line number, line, whether it's known)
+    lexer, _ = get_lexer(language)
+    sd = Streamdown()
+    sd.state.code_checkpoint, sd.state.code_carry = None, ''
+    text = ''
+    for ix, line in enumerate(lineList):
+        now = colors(sd.lex_line(lexer, line))
+        start = len(text)
+        text += line
+        before = colors(clip_tokens([(ttype, value) for _, ttype, value in lexer.get_tokens_unprocessed(text)], start))
+        if now != before:
+            yield ix, line, (language.lower(), line.strip()) in KnownMap
+
+def main():
+    parser = argparse.ArgumentParser(description = "Check that streamed highlighting matches lexing the whole block")
+    parser.add_argument('fileList', nargs = '*', help = "Markdown files (default: the ones in here)")
+    parser.add_argument('-v', '--verbose', action = 'store_true', help = "Show the known differences too")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    fileList = args.fileList or sorted(os.path.join(here, f) for f in os.listdir(here) if f.endswith('.md'))
+    failed = known = 0
+    for path in fileList:
+        for language, lineList in blocks(path):
+            for ix, line, is_known in compare(language, lineList):
+                if is_known:
+                    known += 1
+                else:
+                    failed += 1
+                if args.verbose or not is_known:
+                    print(f"{'known' if is_known else 'FAIL '} {os.path.basename(path)} {language} line {ix + 1}: {line.rstrip()}")
+
+    print(f"{known} known differences")
+    if not failed:
+        print("ok")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Startup check. Runs sd under `python -X importtime` on a little plain prose and
+# fails if something heavy got pulled in for it or if the imports went over budget.
+# Then it does the same with a code block to make sure pygments does show up there.
+#
+#   ./importtime.py [--budget ms]
+#
+# What the bare interpreter imports on its own (site, encodings ...) isn't counted.
+import argparse, os, re, subprocess, sys
+
+Sd = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'streamdown', 'sd.py')
+# None of these should be needed to put prose on the screen
+HeavyList = ['pygments', 'term_image', 'PIL', 'requests', 'asyncio', 'subprocess', 'base64', 'pylatexenc']
+LineRe = re.compile(r'import time:\s*(\d+) \|\s*(\d+) \| (\s*)(\S+)')
+
+def imports(args, data = b''):
+    # name -> (cumulative microseconds, is it top level)
+    res = subprocess.run([sys.executable, '-X', 'importtime'] + args, input = data,
+            stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+    moduleMap = {}
+    for line in res.stderr.decode('utf-8', 'replace').splitlines():
+        m = LineRe.match(line)
+        if m:
+            moduleMap[m.group(4)] = (int(m.group(2)), len(m.group(3)) == 0)
+    return moduleMap
+
+def main():
+    parser = argparse.ArgumentParser(description = "Check what sd imports to render plain prose")
+    parser.add_argument('--budget', type = float, default = 50, help = "Most milliseconds the imports can take (default: 50)")
+    args = parser.parse_args()
+
+    baseline = imports(['-c', 'pass'])
+    prose = imports([Sd], b"Just some *plain* prose, a [link](https://example.com) and `code`.\n")
+    code = imports([Sd], b"```python\nprint('hi')\n```\n")
+
+    failed = 0
+    heavyList = [name for name in prose if name.split('.')[0] in HeavyList]
+    if heavyList:
+        print(f"FAIL prose imported: {', '.join(sorted(heavyList))}")
+        failed += 1
+
+    if not any(name.startswith('pygments') for name in code):
+        print("FAIL a code block didn't import pygments, is the check still looking at the right thing?")
+        failed += 1
+
+    topList = sorted(((us, name) for name, (us, top) in prose.items() if top and name not in baseline), reverse = True)
+    total = sum(us for us, _ in topList) / 1000
+    for us, name in topList[:10]:
+        print(f"{us / 1000:8.2f}ms  {name}")
+    print(f"{total:8.2f}ms  total")
+
+    if total > args.budget:
+        print(f"FAIL over the {args.budget}ms budget")
+        failed += 1
+
+    if not failed:
+        print("ok")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
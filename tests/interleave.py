@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Renders pairs of the markdown files in here on two Streamdown instances, first
+# one after the other and then at the same time in two threads that trickle their
+# input in, and makes sure the interleaved output is the same as the sequential one.
+import io, os, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from streamdown.sd import Streamdown
+
+class Trickle:
+    # Hands out a few bytes per read and gives the other thread a turn
+    def __init__(self, data, size = 7):
+        self.data = data
+        self.size = size
+        self.pos = 0
+
+    def read(self, n):
+        time.sleep(0)
+        chunk = self.data[self.pos : self.pos + min(n, self.size)]
+        self.pos += len(chunk)
+        return chunk
+
+def render(data, res, ix):
+    out = io.StringIO()
+    sd = Streamdown(output = out)
+    sd.setup(width = 80)
+    sd.render(Trickle(data))
+    res[ix] = out.getvalue()
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+fileList = sys.argv[1:] or sorted(f for f in os.listdir('.') if f.endswith('.md'))
+failed = 0
+
+for first, second in zip(fileList, fileList[1:] + fileList[:1]):
+    dataList = [open(first, 'rb').read(), open(second, 'rb').read()]
+
+    serial = [None, None]
+    for ix in range(2):
+        render(dataList[ix], serial, ix)
+
+    together = [None, None]
+    threadList = [threading.Thread(target = render, args = (dataList[ix], together, ix)) for ix in range(2)]
+    for thread in threadList:
+        thread.start()
+    for thread in threadList:
+        thread.join()
+
+    ok = serial == together
+    failed += not ok
+    print(f"{'ok  ' if ok else 'FAIL'} {first} + {second}")
+
+sys.exit(1 if failed else 0)
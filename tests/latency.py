@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Streaming latency benchmark. This plays a markdown file into sd the way a model
+# does, a few tokens at a time at some tokens/second with a bit of jitter, over a
+# pipe (so it goes down the same select + Timeout path as `llm | sd`) and reads what
+# comes out the other side of a pty (so the output side thinks it's a terminal).
+#
+# Every word in the output is matched back up to the word it came from in the input
+# and the lag is the time between the last byte of that word going in and it coming
+# out rendered. You get the p50/p95/p99 of that and the time to first paint as JSON:
+#
+#   ./latency.py qwen3.md --rate 80
+#
+# Words that don't survive rendering as themselves (urls, wrapped cjk, etc) aren't
+# counted, `coverage` says how many made it. Neither are matches to a word that was
+# only written after it was painted, `rejected` says how many of those there were.
+# With the Live feature rows get redrawn in place as a line comes in, a word counts
+# from the first time it was painted. sd and the feed start together like they do in
+# `llm | sd` so the time to first paint includes sd starting up.
+import argparse, codecs, json, os, pty, random, re, select, subprocess, sys, threading, time
+
+Here = os.path.dirname(os.path.abspath(__file__))
+Sd = os.path.join(Here, '..', 'streamdown', 'sd.py')
+AnsiRe = re.compile(r'\033(?:\[[0-9;?]*[a-zA-Z]|][0-9]*;;.*?\\|\\)')
+WordRe = re.compile(r'\w+')
+# What the output is made of: going back to redraw some rows, escape codes, rows and words
+PaintRe = re.compile(r'(?P<rewind>\r\033\[J|\033\[(?P<up>\d+)F\033\[J)|' + AnsiRe.pattern + r'|(?P<row>\n)|(?P<word>\w+)')
+# Roughly what a tokenizer hands out: some leading space and a short run of text
+TokenRe = re.compile(r'\s*(?:\w{1,6}|[^\w\s]{1,3})|\s+')
+
+def chunks(text, rnd, most):
+    # groups of 1 to `most` tokens, like the deltas out of a streaming api
+    tokenList = TokenRe.findall(text)
+    ix = 0
+    while ix < len(tokenList):
+        count = rnd.randint(1, most)
+        yield ''.join(tokenList[ix : ix + count]), count
+        ix += count
+
+def feed(fd, text, rate, jitter, most, seed, timeList):
+    # timeList[i] gets when character i of text was written
+    rnd = random.Random(seed)
+    due = time.monotonic()
+    pos = 0
+    for chunk, count in chunks(text, rnd, most):
+        due += count / rate * rnd.uniform(1 - jitter, 1 + jitter)
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        os.write(fd, chunk.encode('utf-8'))
+        now = time.monotonic()
+        timeList[pos : pos + len(chunk)] = [now] * len(chunk)
+        pos += len(chunk)
+    os.close(fd)
+
+def words(text, timeList):
+    # the escape codes are blanked out in place so offsets still line up with the times
+    text = AnsiRe.sub(lambda m: '\0' * len(m.group(0)), text)
+    return [(m.group(0), timeList[m.end() - 1]) for m in WordRe.finditer(text)]
+
+def align(inList, output, timeList, window):
+    # Walk the output words and find each one a little further along in the input. We
+    # remember how far along the input each row started so a redraw can go back there.
+    # On repetitive text the next word that's the same can be one that hadn't even been
+    # written yet when this was painted, those are counted and the pointer stays put
+    lagMap = {}
+    rejected = 0
+    ptr = 0
+    rowList = [0]
+    for match in PaintRe.finditer(output):
+        if match.group('word'):
+            word, painted = match.group('word'), timeList[match.end() - 1]
+            for ix in range(ptr, min(ptr + window, len(inList))):
+                if inList[ix][0] == word:
+                    if inList[ix][1] > painted:
+                        # anything further along came in later still
+                        rejected += 1
+                    else:
+                        lagMap.setdefault(ix, painted - inList[ix][1])
+                        ptr = ix + 1
+                    break
+
+        elif match.group('row'):
+            rowList.append(ptr)
+
+        elif match.group('rewind'):
+            up = int(match.group('up') or 0)
+            if up:
+                del rowList[-up:]
+            ptr = rowList[-1]
+
+    return list(lagMap.values()), rejected
+
+def percentile(sortedList, p):
+    if not sortedList:
+        return None
+    return sortedList[min(len(sortedList) - 1, int(round(p / 100 * (len(sortedList) - 1))))]
+
+def main():
+    parser = argparse.ArgumentParser(description = "Streamdown streaming latency benchmark")
+    parser.add_argument('filename', nargs = '?', default = 'qwen3.md', help = "Markdown file to replay (default: qwen3.md)")
+    parser.add_argument('-r', '--rate', type = float, default = 100, help = "Tokens per second")
+    parser.add_argument('-j', '--jitter', type = float, default = 0.5, help = "How much each delay can vary, 0.5 is +/-50%%")
+    parser.add_argument('-m', '--most', type = int, default = 3, help = "Most tokens written at once")
+    parser.add_argument('-n', '--limit', type = int, default = 0, help = "Only replay this many characters of the file")
+    parser.add_argument('-w', '--width', type = int, default = 80)
+    parser.add_argument('-c', '--config', help = "Config override passed on to sd, say \"[features]\\nTimeout = 0.05\"")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--window', type = int, default = 64, help = "How far ahead in the input to look for each output word")
+    parser.add_argument('-o', '--output', help = "Write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    path = args.filename if os.path.exists(args.filename) else os.path.join(Here, args.filename)
+    text = open(path, 'rb').read().decode('utf-8', 'replace')
+    if args.limit:
+        text = text[:args.limit]
+
+    master, slave = pty.openpty()
+    inp_r, inp_w = os.pipe()
+    cmd = [sys.executable, Sd, '-w', str(args.width)] + (['-c', args.config] if args.config else [])
+    proc = subprocess.Popen(cmd, stdin = inp_r, stdout = slave, stderr = subprocess.DEVNULL)
+    os.close(inp_r)
+    os.close(slave)
+
+    timeList = [0.0] * len(text)
+    feeder = threading.Thread(target = feed, args = (inp_w, text, args.rate, args.jitter, args.most, args.seed, timeList))
+    start = time.monotonic()
+    feeder.start()
+
+    readList = []
+    while True:
+        ready, _, _ = select.select([master], [], [], 1)
+        if not ready:
+            if proc.poll() is not None:
+                break
+            continue
+        try:
+            data = os.read(master, 65536)
+        except OSError:
+            # the other side of the pty is gone
+            break
+        if not data:
+            break
+        readList.append((time.monotonic(), data))
+
+    feeder.join()
+    proc.wait()
+    os.close(master)
+
+    # utf-8 characters can be split over two reads
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    paintList = [(when, decoder.decode(data)) for when, data in readList]
+    output = ''.join(piece for _, piece in paintList)
+    outTimeList = [when for when, piece in paintList for _ in piece]
+
+    inList = words(text, timeList)
+    lagList, rejected = align(inList, output, outTimeList, args.window)
+    lagList.sort()
+
+    first_paint = next((when for when, piece in paintList if WordRe.search(AnsiRe.sub('', piece))), None)
+    ms = lambda s: None if s is None else round(s * 1000, 3)
+    report = {
+        'file': os.path.basename(path),
+        'chars': len(text),
+        'rate': args.rate,
+        'jitter': args.jitter,
+        'seed': args.seed,
+        'width': args.width,
+        'config': args.config,
+        'exit': proc.returncode,
+        'duration_s': round((readList[-1][0] if readList else time.monotonic()) - start, 3),
+        'time_to_first_paint_ms': ms(first_paint - timeList[0] if first_paint and text else None),
+        'words': len(inList),
+        'matched': len(lagList),
+        'rejected': rejected,
+        'coverage': round(len(lagList) / len(inList), 3) if inList else 0,
+        'lag_ms': {
+            'p50': ms(percentile(lagList, 50)),
+            'p95': ms(percentile(lagList, 95)),
+            'p99': ms(percentile(lagList, 99)),
+            'max': ms(lagList[-1] if lagList else None),
+            'mean': ms(sum(lagList) / len(lagList) if lagList else None),
+        }
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+
+if __name__ == '__main__':
+    main()